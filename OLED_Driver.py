@@ -1,9 +1,10 @@
 # -*- coding:UTF-8 -*-
 
+import os
 import time
 
-import RPi.GPIO as GPIO
-import spidev
+import numpy as np
+from PIL import Image as PIL_Image, ImageDraw as PIL_ImageDraw
 
 # SSD1351
 SSD1351_WIDTH = 128
@@ -51,26 +52,74 @@ YELLOW = 0xFFE0
 WHITE = 0xFFFF
 # buffer
 color_byte = [0x00, 0x00]
-color_fill_byte = [0x00, 0x00] * (SSD1351_WIDTH)
+
+# 4x4 Bayer matrix, scaled to the rounding step of a 5 bit (8) and 6 bit (4) channel
+BAYER_4X4 = np.array([[0, 8, 2, 10],
+                      [12, 4, 14, 6],
+                      [3, 11, 1, 9],
+                      [15, 7, 13, 5]], dtype=np.uint16)
+_levels = np.arange(256, dtype=np.uint16)
+DITHER_LUT_5 = (np.minimum(_levels[None, :] + BAYER_4X4.reshape(16, 1) // 2, 255) & 0xF8).astype(np.uint16)
+DITHER_LUT_6 = (np.minimum(_levels[None, :] + BAYER_4X4.reshape(16, 1) // 4, 255) & 0xFC).astype(np.uint16)
+del _levels
+
+# Partial updates: last frame sent to the panel and the cost of opening a window, in data bytes
+shadow_frame = None
+DIRTY_WINDOW_COST = 32
 
 # GPIO Set
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
 OLED_RST_PIN = 25
 OLED_DC_PIN = 24
 OLED_CS_PIN = 8
-GPIO.setup(OLED_RST_PIN, GPIO.OUT)
-GPIO.setup(OLED_DC_PIN, GPIO.OUT)
-GPIO.setup(OLED_CS_PIN, GPIO.OUT)
-# GPIO init
-GPIO.setwarnings(False)
-GPIO.setup(OLED_RST_PIN, GPIO.OUT)
-GPIO.setup(OLED_DC_PIN, GPIO.OUT)
-GPIO.setup(OLED_CS_PIN, GPIO.OUT)
-# SPI init
-SPI = spidev.SpiDev(0, 0)
-SPI.max_speed_hz = 9000000
-SPI.mode = 0b00
+SPI_SPEED_HZ = 9000000
+
+
+def Use_Transport(gpio, spi):
+    """
+    Routes the driver through a GPIO module and an SPI device, and initializes them
+    :param gpio: RPi.GPIO or a stand-in such as virtual_panel.VirtualGPIO
+    :param spi: spidev.SpiDev or a stand-in such as virtual_panel.VirtualSpiDev
+    """
+    global GPIO, SPI, shadow_frame
+    GPIO = gpio
+    SPI = spi
+    # GPIO init
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setwarnings(False)
+    GPIO.setup(OLED_RST_PIN, GPIO.OUT)
+    GPIO.setup(OLED_DC_PIN, GPIO.OUT)
+    GPIO.setup(OLED_CS_PIN, GPIO.OUT)
+    # SPI init
+    SPI.max_speed_hz = SPI_SPEED_HZ
+    SPI.mode = 0b00
+    shadow_frame = None
+
+
+if os.environ.get("OLED_VIRTUAL"):
+    # Software panel, see virtual_panel.py. OLED_VIRTUAL=realtime makes transfers take their bus time
+    import virtual_panel
+
+    PANEL = virtual_panel.VirtualPanel(SPI_SPEED_HZ, realtime=os.environ["OLED_VIRTUAL"] == "realtime")
+    Use_Transport(virtual_panel.VirtualGPIO(PANEL, OLED_RST_PIN, OLED_DC_PIN, OLED_CS_PIN),
+                  virtual_panel.VirtualSpiDev(PANEL))
+else:
+    import RPi.GPIO
+    import spidev
+
+    PANEL = None
+    Use_Transport(RPi.GPIO, spidev.SpiDev(0, 0))
+
+
+def Spi_Bufsiz():
+    # Largest transfer the spidev kernel module accepts in one ioctl
+    try:
+        with open("/sys/module/spidev/parameters/bufsiz") as bufsiz:
+            return int(bufsiz.read())
+    except (IOError, ValueError):
+        return 4096
+
+
+SPI_BUFSIZ = Spi_Bufsiz()
 
 
 def Set_Color(color):
@@ -124,73 +173,119 @@ def Write_Datas(data):
     OLED_CS(1)
 
 
+def SPI_WriteBuffer(data):
+    # Push a whole buffer (bytes, bytearray or numpy array) in as few transfers as possible
+    data = memoryview(data).cast("B")
+    if hasattr(SPI, "writebytes2"):
+        SPI.writebytes2(data)
+    else:
+        for i in range(0, len(data), SPI_BUFSIZ):
+            SPI_WriteByte(list(data[i:i + SPI_BUFSIZ]))
+
+
+def Compile(sequence):
+    """
+    Turns a list of commands into the byte runs Send transmits, merging neighbours with the same DC level
+    :param sequence: list of (command, parameter, ...) tuples
+    :return: tuple of (dc, bytes) runs
+    """
+    runs = []
+    for command in sequence:
+        for dc, part in ((0, command[:1]), (1, command[1:])):
+            if not part:
+                continue
+            if runs and runs[-1][0] == dc:
+                runs[-1][1].extend(part)
+            else:
+                runs.append((dc, bytearray(part)))
+    return tuple((dc, bytes(part)) for dc, part in runs)
+
+
+def Send(runs, data=None):
+    """
+    Sends byte runs and then optional pixel data in a single CS frame, switching DC only between runs
+    :param runs: (dc, bytes) runs, as returned by Compile or Window_Runs
+    :param data: bytes-like pixel data following the runs
+    """
+    OLED_CS(0)
+    dc = None
+    for run_dc, part in runs:
+        if run_dc != dc:
+            OLED_DC(run_dc)
+            dc = run_dc
+        SPI_WriteBuffer(part)
+    if data is not None:
+        if dc != 1:
+            OLED_DC(1)
+        SPI_WriteBuffer(data)
+    OLED_CS(1)
+
+
+def Window_Runs(x0, y0, x1, y1):
+    # Byte runs restricting RAM writes to the inclusive window (x0, y0) - (x1, y1) and starting a write
+    return ((0, bytes(bytearray((SSD1351_CMD_SETCOLUMN,)))), (1, bytes(bytearray((x0, x1)))),
+            (0, bytes(bytearray((SSD1351_CMD_SETROW,)))), (1, bytes(bytearray((y0, y1)))),
+            (0, bytes(bytearray((SSD1351_CMD_WRITERAM,)))))
+
+
+def Write_Frame(data, window=None):
+    """
+    Sends pixel data, in the same CS frame as the window it goes to
+    :param data: bytes-like RGB565 data
+    :param window: inclusive (x0, y0, x1, y1) window, None to continue the current RAM write
+    """
+    if window is None:
+        Send((), data)
+    else:
+        Send(Window_Runs(*window), data)
+
+
 def RAM_Address():
-    Write_Command(0x15)
-    Write_Data(0x00)
-    Write_Data(0x7f)
-    Write_Command(0x75)
-    Write_Data(0x00)
-    Write_Data(0x7f)
+    Send(RAM_ADDRESS)
+
+
+def Invalidate():
+    # Panel contents no longer known, next frame is sent in full
+    global shadow_frame
+    shadow_frame = None
 
 
 def Fill_Color(color):
-    RAM_Address()
-    Write_Command(0x5c)
+    global shadow_frame
     Set_Color(color)
-    color_fill_byte = color_byte * SSD1351_WIDTH
-    OLED_CS(0)
-    OLED_DC(1)
-    for i in range(0, SSD1351_HEIGHT):
-        SPI_WriteByte(color_fill_byte)
-    OLED_CS(1)
+    shadow_frame = np.empty((SSD1351_HEIGHT, SSD1351_WIDTH), dtype=">u2")
+    Fill_Rect(0, 0, SSD1351_WIDTH, SSD1351_HEIGHT, color)
 
 
 def Clear_Screen():
-    RAM_Address()
-    Write_Command(0x5c)
-    color_fill_byte = [0x00, 0x00] * SSD1351_WIDTH
-    OLED_CS(0)
-    OLED_DC(1)
-    for i in range(0, SSD1351_HEIGHT):
-        SPI_WriteByte(color_fill_byte)
-    OLED_CS(1)
+    global shadow_frame
+    shadow_frame = np.empty((SSD1351_HEIGHT, SSD1351_WIDTH), dtype=">u2")
+    Fill_Rect(0, 0, SSD1351_WIDTH, SSD1351_HEIGHT, BLACK)
 
 
 def Draw_Pixel(x, y):
-    # Bounds check.
-    if ((x >= SSD1351_WIDTH) or (y >= SSD1351_HEIGHT)):
-        return
-    if ((x < 0) or (y < 0)):
-        return
-    Set_Address(x, y)
-    # transfer data
-    Write_Datas(color_byte)
+    Fill_Rect(x, y, 1, 1, Current_Color())
 
 
 def Set_Coordinate(x, y):
     if ((x >= SSD1351_WIDTH) or (y >= SSD1351_HEIGHT)):
         return
     # Set x and y coordinate
-    Write_Command(SSD1351_CMD_SETCOLUMN)
-    Write_Data(x)
-    Write_Data(SSD1351_WIDTH - 1)
-    Write_Command(SSD1351_CMD_SETROW)
-    Write_Data(y)
-    Write_Data(SSD1351_HEIGHT - 1)
-    Write_Command(SSD1351_CMD_WRITERAM)
+    Send(Window_Runs(x, y, SSD1351_WIDTH - 1, SSD1351_HEIGHT - 1))
 
 
 def Set_Address(column, row):
-    Write_Command(SSD1351_CMD_SETCOLUMN)
-    Write_Data(column)  # X start
-    Write_Data(column)  # X end
-    Write_Command(SSD1351_CMD_SETROW)
-    Write_Data(row)  # Y start
-    Write_Data(row + 7)  # Y end
-    Write_Command(SSD1351_CMD_WRITERAM)
+    # X start and end, Y start and end
+    Send(Window_Runs(column, row, column, row + 7))
+
+
+def Set_Window(x0, y0, x1, y1):
+    # Restrict RAM writes to the inclusive window (x0, y0) - (x1, y1)
+    Send(Window_Runs(x0, y0, x1, y1))
 
 
 def Write_text(dat):
+    Invalidate()
     for i in range(0, 8):
         if (dat & 0x01):
             Write_Datas(color_byte)
@@ -206,152 +301,462 @@ def Invert(v):
         Write_Command(SSD1351_CMD_NORMALDISPLAY)
 
 
-def Draw_Pixel(x, y):
-    # Bounds check.
-    if ((x >= SSD1351_WIDTH) or (y >= SSD1351_HEIGHT)):
-        return
-    if ((x < 0) or (y < 0)):
-        return
-    Set_Address(x, y)
-    # transfer data
-    Write_Datas(color_byte)
+# Register setup sent by Device_Init after the reset
+INIT_SEQUENCE = Compile([
+    (0xFD, 0x12),  # command lock
+    (0xFD, 0xB1),  # command lock
+    (0xAE,),  # display off
+    (0xA4,),  # Normal Display mode
+    (0x15, 0x00, 0x7F),  # set column address, start 00 end 127
+    (0x75, 0x00, 0x7F),  # set row address, start 00 end 127
+    (0xB3, 0xF1),
+    (0xCA, 0x7F),
+    (0xA0, 0x74),  # set re-map & data format, Horizontal address increment
+    (0xA1, 0x00),  # set display start line, start 00 line
+    (0xA2, 0x00),  # set display offset
+    (0xAB, 0x01),
+    (0xB4, 0xA0, 0xB5, 0x55),
+    (0xC1, 0xC8, 0x80, 0xC0),
+    (0xC7, 0x0F),
+    (0xB1, 0x32),
+    (0xB2, 0xA4, 0x00, 0x00),
+    (0xBB, 0x17),
+    (0xB6, 0x01),
+    (0xBE, 0x05),
+    (0xA6,),
+])
+RAM_ADDRESS = Compile([(SSD1351_CMD_SETCOLUMN, 0x00, 0x7F), (SSD1351_CMD_SETROW, 0x00, 0x7F)])
 
 
 def Delay(x):
     time.sleep(x / 1000.0)
 
 
-def Device_Init():
+def Device_Init(reset_delay=500):
     OLED_CS(0)
     OLED_RST(0)
-    Delay(500)
+    Delay(reset_delay)
     OLED_RST(1)
-    Delay(500)
+    Delay(reset_delay)
 
-    Write_Command(0xfd)  # command lock
-    Write_Data(0x12)
-    Write_Command(0xfd)  # command lock
-    Write_Data(0xB1)
+    Send(INIT_SEQUENCE)
 
-    Write_Command(0xae)  # display off
-    Write_Command(0xa4)  # Normal Display mode
+    Clear_Screen()
+    Write_Command(0xaf)
 
-    Write_Command(0x15)  # set column address
-    Write_Data(0x00)  # column address start 00
-    Write_Data(0x7f)  # column address end 95
-    Write_Command(0x75)  # set row address
-    Write_Data(0x00)  # row address start 00
-    Write_Data(0x7f)  # row address end 63
 
-    Write_Command(0xB3)
-    Write_Data(0xF1)
+# Draw a horizontal line ignoring any screen rotation.
+def Draw_FastHLine(x, y, length):
+    Draw_HLine(x, y, length, Current_Color())
 
-    Write_Command(0xCA)
-    Write_Data(0x7F)
 
-    Write_Command(0xa0)  # set re-map & data format
-    Write_Data(0x74)  # Horizontal address increment
+def Draw_FastVLine(x, y, length):
+    Draw_VLine(x, y, length, Current_Color())
 
-    Write_Command(0xa1)  # set display start line
-    Write_Data(0x00)  # start 00 line
 
-    Write_Command(0xa2)  # set display offset
-    Write_Data(0x00)
+# Primitives: each one sets the window once and streams its pixels in one burst
 
-    Write_Command(0xAB)
-    Write_Command(0x01)
+def Current_Color():
+    # Color set by Set_Color
+    return (color_byte[0] << 8) | color_byte[1]
 
-    Write_Command(0xB4)
-    Write_Data(0xA0)
-    Write_Data(0xB5)
-    Write_Data(0x55)
 
-    Write_Command(0xC1)
-    Write_Data(0xC8)
-    Write_Data(0x80)
-    Write_Data(0xC0)
+def Color565(r, g, b):
+    return ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
 
-    Write_Command(0xC7)
-    Write_Data(0x0F)
 
-    Write_Command(0xB1)
-    Write_Data(0x32)
+def Color_Run(color, count):
+    # Bytes of count pixels of one color
+    return bytes(bytearray(((color >> 8) & 0xff, color & 0xff))) * count
 
-    Write_Command(0xB2)
-    Write_Data(0xA4)
-    Write_Data(0x00)
-    Write_Data(0x00)
 
-    Write_Command(0xBB)
-    Write_Data(0x17)
+def _Clip(x, y, width, height, limit_width=SSD1351_WIDTH, limit_height=SSD1351_HEIGHT):
+    x0 = max(x, 0)
+    y0 = max(y, 0)
+    x1 = min(x + width, limit_width) - 1
+    y1 = min(y + height, limit_height) - 1
+    if x1 < x0 or y1 < y0:
+        return None
+    return x0, y0, x1, y1
 
-    Write_Command(0xB6)
-    Write_Data(0x01)
 
-    Write_Command(0xBE)
-    Write_Data(0x05)
+def Fill_Rect(x, y, width, height, color):
+    window = _Clip(x, y, width, height)
+    if window is None:
+        return
+    x0, y0, x1, y1 = window
+    Write_Frame(Color_Run(color, (x1 - x0 + 1) * (y1 - y0 + 1)), window)
+    if shadow_frame is not None:
+        shadow_frame[y0:y1 + 1, x0:x1 + 1] = color
+
+
+def Draw_HLine(x, y, length, color):
+    Fill_Rect(x, y, length, 1, color)
+
+
+def Draw_VLine(x, y, length, color):
+    Fill_Rect(x, y, 1, length, color)
+
+
+def Draw_Rect(x, y, width, height, color):
+    """
+    Draws a one pixel outline, its four sides sent in a single CS frame
+    """
+    sides = [(x, y, width, 1), (x, y + height - 1, width, 1), (x, y + 1, 1, height - 2),
+             (x + width - 1, y + 1, 1, height - 2)]
+    runs = []
+    for side in sides:
+        window = _Clip(*side)
+        if window is None:
+            continue
+        x0, y0, x1, y1 = window
+        runs.extend(Window_Runs(*window))
+        runs.append((1, Color_Run(color, (x1 - x0 + 1) * (y1 - y0 + 1))))
+        if shadow_frame is not None:
+            shadow_frame[y0:y1 + 1, x0:x1 + 1] = color
+    if runs:
+        Send(runs)
+
+
+def Blit_Region(x, y, frame):
+    """
+    Copies an RGB565 frame, or part of one, to the panel at (x, y)
+    :param frame: (height, width) array of dtype '>u2'
+    """
+    height, width = frame.shape
+    window = _Clip(x, y, width, height)
+    if window is None:
+        return
+    x0, y0, x1, y1 = window
+    region = np.ascontiguousarray(frame[y0 - y:y1 - y + 1, x0 - x:x1 - x + 1], dtype=">u2")
+    Write_Frame(region, window)
+    if shadow_frame is not None:
+        shadow_frame[y0:y1 + 1, x0:x1 + 1] = region
+
+
+class Canvas(object):
+    """
+    Drawing surface holding RGB565 pixels in panel byte order, so what is drawn on it is sent as is.
+    Drawing is clipped to the canvas, like the panel primitives are clipped to the panel.
+    """
+
+    def __init__(self, width=SSD1351_WIDTH, height=SSD1351_HEIGHT, color=BLACK):
+        """
+        :param color: RGB565 color the canvas starts filled with
+        """
+        self.width = width
+        self.height = height
+        # (height, width) array of dtype '>u2', also what Display_Frame and the display pipeline take
+        self.frame = np.empty((height, width), dtype=">u2")
+        self.frame[:] = color
+
+    def Fill(self, color):
+        self.frame[:] = color
+
+    def Fill_Rect(self, x, y, width, height, color):
+        window = _Clip(x, y, width, height, self.width, self.height)
+        if window is not None:
+            x0, y0, x1, y1 = window
+            self.frame[y0:y1 + 1, x0:x1 + 1] = color
+
+    def Draw_HLine(self, x, y, length, color):
+        self.Fill_Rect(x, y, length, 1, color)
+
+    def Draw_VLine(self, x, y, length, color):
+        self.Fill_Rect(x, y, 1, length, color)
+
+    def Draw_Rect(self, x, y, width, height, color):
+        """
+        Draws a one pixel outline
+        """
+        self.Draw_HLine(x, y, width, color)
+        self.Draw_HLine(x, y + height - 1, width, color)
+        self.Draw_VLine(x, y + 1, height - 2, color)
+        self.Draw_VLine(x + width - 1, y + 1, height - 2, color)
+
+    def Blit(self, x, y, source):
+        """
+        Copies a canvas or an RGB565 frame onto this canvas at (x, y)
+        :param source: Canvas or (height, width) array of dtype '>u2'
+        """
+        frame = getattr(source, "frame", source)
+        height, width = frame.shape
+        window = _Clip(x, y, width, height, self.width, self.height)
+        if window is not None:
+            x0, y0, x1, y1 = window
+            self.frame[y0:y1 + 1, x0:x1 + 1] = frame[y0 - y:y1 - y + 1, x0 - x:x1 - x + 1]
+
+    def Rows(self, y0, y1):
+        """
+        :return: memoryview of the bytes of the inclusive rows y0 to y1, for sending them without a copy
+        """
+        return memoryview(self.frame[y0:y1 + 1]).cast("B")
+
+    def Data(self):
+        return self.Rows(0, self.height - 1)
+
+
+def Blend_Mask(mask, color, background):
+    """
+    Blends color over a solid background through an 8 bit coverage mask, rounding like PIL does when it
+    draws text, and packs the result to RGB565
+    :param mask: (height, width) uint8 array
+    :param color: (r, g, b) of the covered pixels
+    :param background: (r, g, b) of the uncovered pixels
+    :return: (height, width) array of dtype '>u2'
+    """
+    alpha = mask.astype(np.uint32)
+    channels = []
+    for fg, bg in zip(color, background):
+        value = bg * (255 - alpha) + fg * alpha + 128
+        channels.append((value + (value >> 8)) >> 8)
+    r, g, b = channels
+    return (((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)).astype(">u2")
+
+
+def Text_Tile(text, font, color, background, size=None, position=(0, 0)):
+    """
+    Renders text on a solid tile. Only the 8 bit glyph coverage goes through PIL, the tile is RGB565 from
+    the start.
+    :param font: PIL font
+    :param color: (r, g, b) of the text
+    :param background: (r, g, b) of the tile
+    :param size: (width, height) of the tile, the size of the text by default
+    :param position: where the text starts in the tile
+    :return: Canvas
+    """
+    if size is None:
+        size = font.getsize(text)
+    mask = PIL_Image.new("L", size, 0)
+    PIL_ImageDraw.Draw(mask).text(position, text, font=font, fill=255)
+    tile = Canvas(size[0], size[1])
+    tile.frame[:] = Blend_Mask(np.asarray(mask, dtype=np.uint8), color, background)
+    return tile
+
+
+def Coverage_To_RGB565(coverage, color=(255, 255, 255), background=(0, 0, 0)):
+    """
+    Blends a coverage buffer (stimulus.render_circle) into an RGB565 frame through a 256 entry table, the
+    same pixels as Image_To_RGB565(stimulus.to_rgb(coverage)) for white on black
+    :param coverage: (height, width) float array between 0 and 1
+    :return: (height, width) array of dtype '>u2'
+    """
+    key = (tuple(color), tuple(background))
+    table = _coverage_tables.get(key)
+    if table is None:
+        table = Blend_Mask(np.arange(256, dtype=np.uint8), color, background)
+        _coverage_tables[key] = table
+    return table[(coverage * np.float32(255) + np.float32(0.5)).astype(np.uint8)]
+
+
+_coverage_tables = {}
+
+
+def Image_To_RGB565(Image, dither=False):
+    """
+    Converts a PIL image or an (height, width, 3) uint8 array to a big-endian RGB565 frame
+    :param Image: PIL image or numpy array holding RGB pixels
+    :param dither: apply 4x4 ordered dithering before truncating each channel
+    :return: (height, width) numpy array of dtype '>u2', ready to be sent as is
+    """
+    if hasattr(Image, "convert"):
+        Image = Image.convert("RGB")
+    rgb = np.asarray(Image, dtype=np.uint8)[:, :, :3]
+    r = rgb[:, :, 0].astype(np.uint16)
+    g = rgb[:, :, 1].astype(np.uint16)
+    b = rgb[:, :, 2].astype(np.uint16)
+    if dither:
+        height, width = r.shape
+        rows = np.arange(height)[:, None] & 3
+        cols = np.arange(width)[None, :] & 3
+        cell = rows * 4 + cols
+        r = DITHER_LUT_5[cell, r]
+        g = DITHER_LUT_6[cell, g]
+        b = DITHER_LUT_5[cell, b]
+    frame = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+    return frame.astype(">u2")
+
+
+def Dirty_Rects(old, new, window_cost=DIRTY_WINDOW_COST):
+    """
+    Finds the windows that have to be rewritten to turn the old frame into the new one
+    :param old: frame currently on the panel
+    :param new: frame to be shown
+    :param window_cost: overhead of opening one more window, in bytes of pixel data
+    :return: list of inclusive (x0, y0, x1, y1) windows, empty if nothing changed
+    """
+    height, width = new.shape
+    changed = old != new
+    # Skipping fewer pixels than this costs more than opening another window
+    gap = window_cost // 2
+    rects = []
+    for y in np.flatnonzero(changed.any(axis=1)):
+        y = int(y)
+        cols = np.flatnonzero(changed[y])
+        breaks = np.flatnonzero(np.diff(cols) > gap + 1)
+        starts = [int(cols[0])] + [int(x) for x in cols[breaks + 1]]
+        ends = [int(x) for x in cols[breaks]] + [int(cols[-1])]
+        for x0, x1 in zip(starts, ends):
+            # Grow a window touching the previous row when the extra pixels are cheap enough
+            for rect in rects:
+                if rect[3] < y - 1 or rect[0] > x1 + gap or x0 > rect[2] + gap:
+                    continue
+                grown = [min(rect[0], x0), rect[1], max(rect[2], x1), y]
+                extra = _Area(grown) - _Area(rect) - (x1 - x0 + 1)
+                if extra * 2 <= window_cost:
+                    rect[:] = grown
+                    break
+            else:
+                rects.append([x0, y, x1, y])
+
+    # Merge windows whose union is cheaper than sending them separately
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                union = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                if (_Area(union) - _Area(a) - _Area(b)) * 2 <= window_cost:
+                    rects[i] = union
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    if sum(_Area(rect) * 2 + window_cost for rect in rects) >= width * height * 2:
+        return [(0, 0, width - 1, height - 1)]
+    return [tuple(rect) for rect in rects]
+
+
+def _Area(rect):
+    return (rect[2] - rect[0] + 1) * (rect[3] - rect[1] + 1)
+
+
+def Frame_Runs(frame, windows, y=0):
+    """
+    Byte runs writing windows of a frame, all of them sent by a single Send
+    :param frame: (height, width) array of dtype '>u2'
+    :param windows: inclusive (x0, y0, x1, y1) windows of frame
+    :param y: panel row of the first row of frame
+    """
+    runs = []
+    for x0, y0, x1, y1 in windows:
+        runs.extend(Window_Runs(x0, y + y0, x1, y + y1))
+        runs.append((1, np.ascontiguousarray(frame[y0:y1 + 1, x0:x1 + 1])))
+    return runs
+
+
+def Display_Frame(frame, full=False):
+    """
+    Sends an RGB565 frame, rewriting only the windows that differ from the last frame sent, in a single CS frame
+    :param frame: (height, width) array of dtype '>u2'
+    :param full: resend the whole frame regardless of what the panel shows
+    """
+    global shadow_frame
+    if full or shadow_frame is None or shadow_frame.shape != frame.shape:
+        Write_Frame(frame, (0, 0, SSD1351_WIDTH - 1, SSD1351_HEIGHT - 1))
+    else:
+        runs = Frame_Runs(frame, Dirty_Rects(shadow_frame, frame))
+        if runs:
+            Send(runs)
+    shadow_frame = frame.copy()
 
-    Write_Command(0xA6)
 
-    Clear_Screen()
-    Write_Command(0xaf)
+def Display_Image(Image, dither=False):
+    if (Image is None):
+        return
 
+    Display_Frame(Image_To_RGB565(Image, dither))
 
-# Draw a horizontal line ignoring any screen rotation.
-def Draw_FastHLine(x, y, length):
-    # Bounds check
-    if ((x >= SSD1351_WIDTH) or (y >= SSD1351_HEIGHT)):
-        return
-    # X bounds check
-    if ((x + length) > SSD1351_WIDTH):
-        length = SSD1351_WIDTH - x - 1
-    if (length < 0):
-        return
-    # set location
-    Write_Command(SSD1351_CMD_SETCOLUMN)
-    Write_Data(x)
-    Write_Data(x + length - 1)
-    Write_Command(SSD1351_CMD_SETROW)
-    Write_Data(y)
-    Write_Data(y)
-    # fill!
-    Write_Command(SSD1351_CMD_WRITERAM)
 
-    for i in range(0, length):
-        Write_Datas(color_byte)
+# Transitions: animated through the contrast, start line and scroll registers, a couple of bytes per step
 
+CONTRAST_LEVELS = 16
 
-def Draw_FastVLine(x, y, length):
-    # Bounds check
-    if ((x >= SSD1351_WIDTH) or (y >= SSD1351_HEIGHT)):
-        return
-    # X bounds check
-    if (y + length > SSD1351_HEIGHT):
-        length = SSD1351_HEIGHT - y - 1
-    if (length < 0):
-        return
-    # set location
-    Write_Command(SSD1351_CMD_SETCOLUMN)
-    Write_Data(x)
-    Write_Data(x)
-    Write_Command(SSD1351_CMD_SETROW)
-    Write_Data(y)
-    Write_Data(y + length - 1)
-    # fill!
-    Write_Command(SSD1351_CMD_WRITERAM)
-
-    for i in range(0, length):
-        Write_Datas(color_byte)
-
-
-def Display_Image(Image):
-    if (Image == None):
-        return
 
-    Set_Coordinate(0, 0)
-    buffer1 = Image.load()
-    for j in range(0, SSD1351_WIDTH):
-        for i in range(0, SSD1351_HEIGHT):
-            color_fill_byte[i * 2] = ((buffer1[i, j][0] & 0xF8) | (buffer1[i, j][1] >> 5))
-            color_fill_byte[i * 2 + 1] = (((buffer1[i, j][1] << 3) & 0xE0) | (buffer1[i, j][2] >> 3))
-        Write_Datas(color_fill_byte)
+def Set_Contrast(level):
+    """
+    :param level: master contrast, 0 (darkest) to 15
+    """
+    Send(((0, bytes(bytearray((SSD1351_CMD_CONTRASTMASTER,)))), (1, bytes(bytearray((level & 0x0F,))))))
+
+
+def Set_Start_Line(line):
+    """
+    Shows the RAM starting from row line at the top of the panel, the rows above wrap to the bottom
+    """
+    Send(((0, bytes(bytearray((SSD1351_CMD_STARTLINE,)))), (1, bytes(bytearray((line % SSD1351_HEIGHT,))))))
+
+
+def Set_Display_Offset(offset):
+    """
+    Moves the picture up by offset rows, wrapping like Set_Start_Line
+    """
+    Send(((0, bytes(bytearray((SSD1351_CMD_DISPLAYOFFSET,)))), (1, bytes(bytearray((offset % SSD1351_HEIGHT,))))))
+
+
+def Start_Scroll(amount, start_row=0, rows=SSD1351_HEIGHT, interval=1):
+    """
+    Starts the panel scrolling rows horizontally on its own. The RAM must not be written until Stop_Scroll.
+    :param amount: columns per step, 1 to 63 to the right, 64 to 255 to the left
+    :param interval: time between steps, 0 (fastest) to 3 (slowest)
+    """
+    Send(Compile([(SSD1351_CMD_HORIZSCROLL, amount, start_row, rows, 0x00, interval),
+                  (SSD1351_CMD_STARTSCROLL,)]))
+
+
+def Stop_Scroll():
+    """
+    Stops scrolling, the scrolled rows have to be rewritten afterwards
+    """
+    Write_Command(SSD1351_CMD_STOPSCROLL)
+    Invalidate()
+
+
+def Fade(start, end, duration):
+    """
+    Steps the master contrast from start to end over duration seconds
+    """
+    step = 1 if end >= start else -1
+    levels = range(start + step, end + step, step)
+    for level in levels:
+        Delay(duration * 1000.0 / len(levels))
+        Set_Contrast(level)
+
+
+def Fade_To_Frame(frame, duration):
+    """
+    Fades the panel out, replaces the frame while it is dark and fades it back in
+    :param frame: (height, width) array of dtype '>u2'
+    """
+    Fade(CONTRAST_LEVELS - 1, 0, duration / 2.0)
+    Display_Frame(frame)
+    Fade(0, CONTRAST_LEVELS - 1, duration / 2.0)
+
+
+def Slide_To_Frame(frame, duration, up=True, rows_per_step=8):
+    """
+    Slides the new frame in from the bottom (or the top) while the current one slides out, by moving the
+    start line. RAM row r only ever receives row r of the new frame, written just before it comes into
+    view, so the whole animation sends what Display_Frame would.
+    :param frame: (height, width) array of dtype '>u2'
+    :param up: slide up, the new frame coming in from the bottom
+    """
+    if shadow_frame is None:
+        Display_Frame(frame, full=True)
+        return
+    steps = range(0, SSD1351_HEIGHT, rows_per_step)
+    for y in steps:
+        started = time.monotonic()
+        if up:
+            y0, y1 = y, min(y + rows_per_step, SSD1351_HEIGHT) - 1
+        else:
+            y0, y1 = max(SSD1351_HEIGHT - y - rows_per_step, 0), SSD1351_HEIGHT - y - 1
+        runs = Frame_Runs(frame[y0:y1 + 1], Dirty_Rects(shadow_frame[y0:y1 + 1], frame[y0:y1 + 1]), y0)
+        if runs:
+            Send(runs)
+        shadow_frame[y0:y1 + 1] = frame[y0:y1 + 1]
+        Set_Start_Line(y1 + 1 if up else y0)
+        Delay(max(duration / len(steps) - (time.monotonic() - started), 0) * 1000.0)
@@ -0,0 +1,221 @@
+# -*- coding:UTF-8 -*-
+"""
+Statistics over the stored test history.
+
+Run with "python analysis.py [data file] [user]" for a report per eye and the latest tests. The data file is
+the results database (data/kaleyedoscope.db by default), or the YAML data file of older versions.
+The tests are flattened into columnar arrays, kept in <data file>[.<user>].columns.npz until the data changes,
+and everything after that is vectorized.
+"""
+
+import itertools
+import json
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import pandas as pd
+
+import journal
+
+# Changes whenever columns returns something different, so older caches are not used
+COLUMNS_VERSION = 2
+
+
+def load(path="data/data"):
+    """
+    Reads the data file and its journal, without changing them, so it can run while a test is going on
+    :return: data dict
+    """
+    return journal.read(path)
+
+
+def stamp(path):
+    """
+    :return: version of the columns, modification time and size of the data file and of its journal (the
+             write-ahead log of a database), to tell when they changed
+    """
+    result = [COLUMNS_VERSION]
+    for name in (path, path + ("-wal" if path.endswith(".db") else ".journal")):
+        if os.path.exists(name):
+            info = os.stat(name)
+            result.extend((int(info.st_mtime * 1e6), info.st_size))
+        else:
+            result.extend((0, 0))
+    return result
+
+
+def load_columns(path="data/kaleyedoscope.db", user="default"):
+    """
+    Returns the columns of the history stored at path, reading them from the .columns.npz cache when the data
+    has not changed since it was written, otherwise from the data and rewriting the cache
+    :param user: whose tests to read from a database
+    """
+    current = stamp(path)
+    if path.endswith(".db"):
+        cache_path = "%s.%s.columns.npz" % (path, user)
+    else:
+        cache_path = path + ".columns.npz"
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path, allow_pickle=False) as saved:
+                if saved["stamp"].tolist() == current:
+                    return dict((key, saved[key]) for key in saved.files if key != "stamp")
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    if path.endswith(".db"):
+        arrays = database_columns(path, user)
+    else:
+        arrays = columns(load(path))
+    try:
+        with open(cache_path, "wb") as cache:
+            np.savez(cache, stamp=np.array(current, dtype=np.int64), **arrays)
+    except (IOError, OSError):
+        pass
+    return arrays
+
+
+def columns(data):
+    """
+    Flattens the finished tests into arrays, tests without thresholds were not finished and are left out
+    :return: dict of arrays with one entry per test, except "upper" and "lower" which hold the thresholds of
+             every test one after the other, "length" of them belonging to each test, and "stored" which is
+             the number of tests including the unfinished ones
+    """
+    tests = [(key, test) for key, test in (data.get("tests") or {}).items()
+             if test and test.get("upper_thresholds") and test.get("lower_thresholds")]
+    length = np.array([len(test["upper_thresholds"]) for _, test in tests], dtype=np.int64)
+    total = int(length.sum())
+    return {
+        "stored": np.array(len(data.get("tests") or {})),
+        "test": np.array([int(key) for key, _ in tests], dtype=np.int64),
+        "eye": np.array([test.get("eye") or "?" for _, test in tests], dtype="U8"),
+        "method": np.array([test.get("method") or "staircase" for _, test in tests], dtype="U16"),
+        "date": pd.to_datetime([test.get("date") for _, test in tests]).to_numpy(),
+        "sanity_checks": np.array([test.get("check_sanity_num", 0) for _, test in tests], dtype=np.int64),
+        "incorrect_sanity_checks": np.array([test.get("incorrect_sanity_checks", 0) for _, test in tests],
+                                            dtype=np.int64),
+        "length": length,
+        # -1 where the trials of the test were not saved
+        "trials": np.array([len(test["trials"]) if test.get("trials") else -1 for _, test in tests], dtype=np.int64),
+        "upper": np.fromiter(itertools.chain.from_iterable(test["upper_thresholds"] for _, test in tests),
+                             dtype=np.float64, count=total),
+        "lower": np.fromiter(itertools.chain.from_iterable(test["lower_thresholds"] for _, test in tests),
+                             dtype=np.float64, count=total),
+    }
+
+
+def database_columns(path, user="default"):
+    """
+    Same as columns, for the tests of a user in the results database
+    """
+    connection = sqlite3.connect(path)
+    try:
+        stored = connection.execute("SELECT COUNT(*) FROM tests JOIN users ON users.id = tests.user_id "
+                                    "WHERE users.name = ?", (user,)).fetchone()[0]
+        rows = connection.execute(
+            "SELECT number, eye, method, date, check_sanity_num, incorrect_sanity_checks, "
+            "(SELECT COUNT(*) FROM trials WHERE trials.user_id = tests.user_id AND trials.test = tests.number), "
+            "upper_thresholds, lower_thresholds FROM tests JOIN users ON users.id = tests.user_id "
+            "WHERE users.name = ? AND finished = 1 ORDER BY number", (user,)).fetchall()
+    finally:
+        connection.close()
+    upper = [json.loads(row[7]) for row in rows]
+    lower = [json.loads(row[8]) for row in rows]
+    length = np.array([len(thresholds) for thresholds in upper], dtype=np.int64)
+    total = int(length.sum())
+    return {
+        "stored": np.array(stored),
+        "test": np.array([row[0] for row in rows], dtype=np.int64),
+        "eye": np.array([row[1] or "?" for row in rows], dtype="U8"),
+        "method": np.array([row[2] for row in rows], dtype="U16"),
+        "date": pd.to_datetime([row[3] for row in rows]).to_numpy(),
+        "sanity_checks": np.array([row[4] or 0 for row in rows], dtype=np.int64),
+        "incorrect_sanity_checks": np.array([row[5] or 0 for row in rows], dtype=np.int64),
+        "length": length,
+        # Migrated tests may not have their trials either
+        "trials": np.array([row[6] or -1 for row in rows], dtype=np.int64),
+        "upper": np.fromiter(itertools.chain.from_iterable(upper), dtype=np.float64, count=total),
+        "lower": np.fromiter(itertools.chain.from_iterable(lower), dtype=np.float64, count=total),
+    }
+
+
+def summarize(arrays):
+    """
+    Computes the result of every test
+    :param arrays: as returned by columns
+    :return: DataFrame indexed by test number: eye, method, date, final upper and lower thresholds, threshold
+             (their midpoint), rounds and trials until the staircase converged, sanity checks and their failure
+             rate
+    """
+    last = np.cumsum(arrays["length"]) - 1
+    upper = arrays["upper"][last]
+    lower = arrays["lower"][last]
+    # Every round adds to both threshold lists. A round of the staircase shows two circles or one sanity check,
+    # which gives the number of trials of the tests that did not save them
+    rounds = arrays["length"] - 1
+    sanity = arrays["sanity_checks"]
+    trials = np.where(arrays["trials"] >= 0, arrays["trials"], 2 * rounds - sanity)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        failure_rate = np.where(sanity > 0, arrays["incorrect_sanity_checks"] / sanity.astype(np.float64), np.nan)
+    frame = pd.DataFrame({
+        "eye": arrays["eye"],
+        "method": arrays["method"],
+        "date": arrays["date"],
+        "upper": upper,
+        "lower": lower,
+        "threshold": (upper + lower) / 2,
+        "rounds": rounds,
+        "trials": trials,
+        "sanity_checks": sanity,
+        "incorrect_sanity_checks": arrays["incorrect_sanity_checks"],
+        "sanity_failure_rate": failure_rate,
+    }, index=pd.Index(arrays["test"], name="test"))
+    return frame.sort_index()
+
+
+def eye_report(results):
+    """
+    Aggregates the test results of each eye
+    :param results: as returned by summarize
+    :return: DataFrame indexed by eye, trend is the least squares slope of the threshold in degrees per 30 days
+    """
+    grouped = results.groupby("eye")
+    report = pd.DataFrame({
+        "tests": grouped.size(),
+        "threshold": grouped["threshold"].mean(),
+        "median": grouped["threshold"].median(),
+        "best": grouped["threshold"].min(),
+        "trials": grouped["trials"].mean(),
+        "sanity_failure_rate": grouped["incorrect_sanity_checks"].sum() / grouped["sanity_checks"].sum(),
+    })
+
+    dated = results[results["date"].notna()]
+    days = (dated["date"] - dated["date"].min()).dt.total_seconds().to_numpy() / 86400.0
+    y = dated["threshold"].to_numpy()
+    sums = pd.DataFrame({"n": 1.0, "x": days, "y": y, "xx": days * days, "xy": days * y},
+                        index=dated.index).groupby(dated["eye"].to_numpy()).sum()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (sums["n"] * sums["xy"] - sums["x"] * sums["y"]) / (sums["n"] * sums["xx"] - sums["x"] ** 2)
+    report["trend"] = (slope * 30).replace([np.inf, -np.inf], np.nan)
+    return report
+
+
+def main(path="data/kaleyedoscope.db", user="default", latest=10):
+    arrays = load_columns(path, user)
+    results = summarize(arrays)
+    unfinished = int(arrays["stored"]) - len(results)
+    print("%d finished tests, %d unfinished left out" % (len(results), unfinished))
+    if not len(results):
+        return
+    pd.set_option("display.width", 120)
+    print("")
+    print(eye_report(results).to_string(float_format=lambda value: "%.3f" % value))
+    print("")
+    print("Latest tests:")
+    print(results.tail(latest).to_string(float_format=lambda value: "%.3f" % value))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
@@ -0,0 +1,120 @@
+# -*- coding:UTF-8 -*-
+"""
+Measures the OLED display path on the virtual panel, no Raspberry Pi needed.
+
+Run with "python benchmark.py". For every step it reports the CPU time spent in Python, the SPI
+traffic the panel received, and checks that the panel RAM ends up holding the expected frame.
+"""
+
+import os
+import time
+
+os.environ["OLED_VIRTUAL"] = "1"
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import OLED_Driver as OLED
+import stimulus
+from pipeline import DisplayPipeline
+
+REPEAT = 50
+
+
+def measure(name, step, expected=None, repeat=REPEAT, setup=None):
+    """
+    Runs step repeat times and prints the average cost of one run
+    :param step: function doing the work, called with no arguments
+    :param expected: frame the panel RAM must hold afterwards
+    :param setup: function called before every run, not timed
+    """
+    cpu = 0.0
+    stats = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        OLED.PANEL.reset_stats()
+        start = time.time()
+        step()
+        cpu += time.time() - start
+        stats = OLED.PANEL.stats()
+    cpu /= repeat
+    ok = ""
+    if expected is not None:
+        ok = "ok" if (OLED.PANEL.frame() == expected).all() else "MISMATCH"
+    frame_time = cpu + stats["bus_seconds"]
+    print("%-22s %8.2f ms cpu %7.2f ms bus %7.1f fps %6d bytes %4d transfers %4d CS %4d DC  %s" % (
+        name, cpu * 1000, stats["bus_seconds"] * 1000, 1 / frame_time, stats["command_bytes"] + stats["data_bytes"],
+        stats["spi_calls"], stats["cs_toggles"], stats["dc_toggles"], ok))
+
+
+def menu_image(outline=False):
+    image = Image.new("RGB", (OLED.SSD1351_WIDTH, OLED.SSD1351_HEIGHT), "DIMGREY")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([(40, 64), (88, 86)], fill="BLUE")
+    draw.rectangle([(40, 96), (88, 118)], fill="DARKORANGE")
+    draw.text((10, 2), "Was that a", fill="WHITE")
+    if outline:
+        draw.rectangle([(40, 64), (88, 86)], outline="BLACK")
+    return image
+
+
+def overlap(count=20):
+    """
+    Renders and shows count circles with the panel taking real bus time, first one after the other, then
+    through the display pipeline so each circle is rendered while the previous one is sent
+    """
+    def render(i):
+        return OLED.Coverage_To_RGB565(stimulus.render_circle(5.0 + i, 6, 1.0, 4, OLED.SSD1351_WIDTH))
+
+    OLED.PANEL.realtime = True
+    start = time.time()
+    for i in range(count):
+        OLED.Display_Frame(render(i), full=True)
+    serial = time.time() - start
+
+    pipeline = DisplayPipeline(lambda frame: OLED.Display_Frame(frame, full=True), OLED.shadow_frame.shape, ">u2")
+    start = time.time()
+    for i in range(count):
+        pipeline.submit(render(i))
+    pipeline.fence()
+    pipelined = time.time() - start
+    # Time the caller is held up by a single frame
+    start = time.time()
+    pipeline.submit(render(count - 1))
+    blocked = time.time() - start
+    pipeline.close()
+    OLED.PANEL.realtime = False
+    ok = "ok" if (OLED.PANEL.frame() == render(count - 1)).all() else "MISMATCH"
+    print("%-22s %8.2f ms serial %7.2f ms pipelined per frame, submit returns after %.2f ms  %s" % (
+        "render + full send", serial * 1000 / count, pipelined * 1000 / count, blocked * 1000, ok))
+
+
+def main():
+    print("SPI at %.1f MHz, %d repeats" % (OLED.SPI_SPEED_HZ / 1e6, REPEAT))
+    measure("Device_Init", lambda: OLED.Device_Init(reset_delay=0), repeat=5)
+
+    menu = menu_image()
+    selected = menu_image(outline=True)
+    menu_frame = OLED.Image_To_RGB565(menu)
+    measure("full frame", lambda: OLED.Display_Image(menu), menu_frame, setup=OLED.Invalidate)
+    measure("full frame, dithered", lambda: OLED.Display_Image(menu, dither=True), setup=OLED.Invalidate)
+    measure("button outline", lambda: OLED.Display_Image(selected), OLED.Image_To_RGB565(selected),
+            setup=lambda: OLED.Display_Image(menu))
+
+    circle = stimulus.to_rgb(stimulus.render_circle(5.0, 6, 1.0, 4, OLED.SSD1351_WIDTH))
+    circle_frame = OLED.Image_To_RGB565(circle)
+    measure("circle, rendered", lambda: OLED.Display_Image(
+        stimulus.to_rgb(stimulus.render_circle(5.0, 6, 1.0, 4, OLED.SSD1351_WIDTH))), circle_frame,
+        setup=OLED.Clear_Screen)
+    measure("circle, cached frame", lambda: OLED.Display_Frame(circle_frame), circle_frame, setup=OLED.Clear_Screen)
+    measure("Clear_Screen", OLED.Clear_Screen, np.zeros_like(circle_frame))
+
+    overlap()
+
+    if OLED.PANEL.warnings:
+        print("panel warnings: " + "; ".join(sorted(set(OLED.PANEL.warnings))))
+
+
+if __name__ == "__main__":
+    main()
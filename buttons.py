@@ -0,0 +1,76 @@
+# -*- coding:UTF-8 -*-
+"""
+Edge triggered, debounced input from the two push buttons.
+"""
+
+import queue
+import time
+
+QUIT = "quit"
+
+
+class Buttons(object):
+    """
+    Queues button presses from GPIO edge interrupts, so waiting for one does not keep the CPU busy.
+    Holding both buttons down for quit_hold seconds asks to quit. A press is returned as soon as it happens,
+    when the other button follows, the next wait sees both held and times the quit from when they went down.
+    """
+
+    def __init__(self, gpio, pins, bouncetime=50, quit_hold=2.0):
+        """
+        :param gpio: RPi.GPIO module
+        :param pins: BCM pins of the buttons, reported as 1, 2, ... in that order
+        :param bouncetime: debounce time in milliseconds
+        :param quit_hold: seconds both buttons have to be held down to quit
+        """
+        self.gpio = gpio
+        self.pins = pins
+        self.quit_hold = quit_hold
+        self._events = queue.Queue()
+        # time.monotonic() of the last press of each pin
+        self._pressed_at = dict((pin, 0.0) for pin in pins)
+        for pin in pins:
+            gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_DOWN)
+            gpio.add_event_detect(pin, gpio.RISING, callback=self._pressed, bouncetime=bouncetime)
+
+    def _pressed(self, pin):
+        # Runs on the RPi.GPIO callback thread
+        self._pressed_at[pin] = time.monotonic()
+        self._events.put(pin)
+
+    def _held(self):
+        return all(self.gpio.input(pin) == self.gpio.HIGH for pin in self.pins)
+
+    def clear(self):
+        """
+        Forgets presses made while no one was waiting for them
+        """
+        while True:
+            try:
+                self._events.get_nowait()
+            except queue.Empty:
+                return
+
+    def wait(self):
+        """
+        Blocks until a button is pressed
+        :return: number of the button pressed, or QUIT if both were held down
+        """
+        self.clear()
+        while True:
+            # Both buttons may already be down, their edges came before this call and no more will come
+            if not self._held():
+                pin = self._events.get()
+                if not self._held():
+                    return self.pins.index(pin) + 1
+            # Both buttons down, wait to see if they are held long enough to quit
+            deadline = max(self._pressed_at.values()) + self.quit_hold
+            while self._held():
+                if time.monotonic() >= deadline:
+                    return QUIT
+                time.sleep(0.05)
+            self.clear()
+
+    def close(self):
+        for pin in self.pins:
+            self.gpio.remove_event_detect(pin)
@@ -0,0 +1,70 @@
+# -*- coding:UTF-8 -*-
+"""
+Size-bounded least recently used cache.
+"""
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Keeps the most recently used values until their total size exceeds max_bytes
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: memory budget, the least recently used values are evicted beyond it
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        :return: cached value for key, or None on a miss
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size):
+        """
+        Stores a value, evicting the least recently used ones to stay within budget
+        :param size: memory held by value, in bytes
+        """
+        if key in self._entries:
+            self.bytes -= self._entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self.bytes -= self._entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self._entries), "bytes": self.bytes}
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return "%d hits, %d misses (%.0f%% hit rate), %d evictions, %d entries in %d KB" % (
+            self.hits, self.misses, hit_rate, self.evictions, len(self._entries), self.bytes // 1024)
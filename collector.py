@@ -0,0 +1,222 @@
+# -*- coding:UTF-8 -*-
+"""
+Collects the test results uploaded by many KalEYEdoscope units into one SQLite database.
+
+Run with "python collector.py [--host 0.0.0.0] [--port 8765] [--database collected.db]" and start the units
+with "-r <host>:<port>". Devices send batches of records as JSON lines and get a line back once the batch is
+committed:
+    {"device": "kiosk-3", "records": [{...}, ...]}  ->  {"ok": 2}
+A batch that can never be stored is answered with {"refused": "<reason>"}, one that failed for now (the database
+could not be written) with {"error": "<reason>"} and is worth sending again. Records of all connections are
+inserted together in bulk by a single writer, a batch that breaks the bulk insert is inserted on its own so the
+others are still stored. When the writer falls behind,
+connections stop being read, so devices are slowed down by TCP instead of the server running out of memory.
+"""
+
+import argparse
+import asyncio
+import json
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    device TEXT NOT NULL,
+    user TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    eye TEXT,
+    date TEXT,
+    method TEXT,
+    baseline INTEGER,
+    lower_thresholds TEXT,
+    upper_thresholds TEXT,
+    check_sanity_num INTEGER,
+    incorrect_sanity_checks INTEGER,
+    bayesian TEXT,
+    trials TEXT,
+    received TEXT NOT NULL,
+    PRIMARY KEY (device, user, number)
+);
+CREATE INDEX IF NOT EXISTS results_date ON results (date);
+"""
+
+# Fields of an uploaded record, in the order of the results columns; lists and dicts are stored as JSON
+FIELDS = ("user", "number", "eye", "date", "method", "baseline", "lower_thresholds", "upper_thresholds",
+          "check_sanity_num", "incorrect_sanity_checks", "bayesian", "trials")
+# Longest line accepted from a device
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+def row(device, record, received):
+    """
+    :return: values of the results columns for a record
+    :raise ValueError: the record cannot be stored
+    """
+    if not isinstance(record, dict):
+        raise ValueError("record is not an object")
+    if not isinstance(record.get("user"), str):
+        raise ValueError("record without a user name")
+    if not isinstance(record.get("number"), int) or isinstance(record["number"], bool):
+        raise ValueError("record without a test number")
+    values = [device]
+    for field in FIELDS:
+        value = record.get(field)
+        values.append(json.dumps(value) if isinstance(value, (list, dict)) else value)
+    values.append(received)
+    return values
+
+
+class Collector(object):
+    """
+    Accepts device connections and inserts their records in bulk
+    """
+
+    def __init__(self, path="collected.db", batch_size=5000, batch_delay=0.05, pending=20000):
+        """
+        :param path: database file, created if missing
+        :param batch_size: most records inserted in one transaction
+        :param batch_delay: seconds the writer waits to gather more records into one transaction
+        :param pending: records waiting to be inserted after which connections stop being read
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.pending = pending
+        self.connections = 0
+        self.received = 0
+        # Records read but not inserted yet
+        self.waiting = 0
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._queue = None
+        self._server = None
+
+    async def start(self, host="127.0.0.1", port=8765, backlog=4096):
+        """
+        Starts listening and inserting, returns once the server is up
+        """
+        self._queue = asyncio.Queue()
+        self._space = asyncio.Condition()
+        self._writer = asyncio.ensure_future(self._write())
+        self._server = await asyncio.start_server(self._handle, host, port, backlog=backlog, limit=LINE_LIMIT)
+        return self._server
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        await self._queue.join()
+        self._writer.cancel()
+        self._connection.close()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, ConnectionError):
+                    break
+                if not line:
+                    break
+                # Checked before queueing, one bad record must not fail the batches committed together with it
+                try:
+                    message = json.loads(line.decode("utf-8"))
+                    rows = []
+                    for i, record in enumerate(message["records"]):
+                        try:
+                            rows.append(row(str(message["device"]), record, time.strftime("%Y-%m-%d %H:%M:%S")))
+                        except ValueError as error:
+                            raise ValueError("record %d: %s" % (i, error))
+                    if len(rows) > self.pending:
+                        raise ValueError("batch larger than %d records" % self.pending)
+                except (ValueError, KeyError, TypeError, AttributeError) as error:
+                    writer.write((json.dumps({"refused": str(error)}) + "\n").encode("utf-8"))
+                    await writer.drain()
+                    continue
+                # Waiting for room here stops reading this connection until the writer catches up. The whole
+                # batch is reserved at once, connections holding part of the room could otherwise block each other
+                async with self._space:
+                    await self._space.wait_for(lambda: self.waiting + len(rows) <= self.pending)
+                    self.waiting += len(rows)
+                done = asyncio.get_event_loop().create_future()
+                await self._queue.put((rows, done))
+                try:
+                    await done
+                except OverflowError as error:
+                    writer.write((json.dumps({"refused": str(error)}) + "\n").encode("utf-8"))
+                except sqlite3.Error as error:
+                    writer.write((json.dumps({"error": str(error)}) + "\n").encode("utf-8"))
+                else:
+                    writer.write((json.dumps({"ok": len(rows)}) + "\n").encode("utf-8"))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _write(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self.batch_delay)
+            count = len(batch[0][0])
+            while count < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                count += len(batch[-1][0])
+            rows = [values for part, _ in batch for values in part]
+            try:
+                # Off the event loop, so connections keep being served during the commit
+                await loop.run_in_executor(None, self._insert, rows)
+            except (sqlite3.Error, OverflowError):
+                # Insert the batch of each connection on its own, so only the one that fails is answered with
+                # the error
+                for part, done in batch:
+                    try:
+                        await loop.run_in_executor(None, self._insert, part)
+                    except (sqlite3.Error, OverflowError) as error:
+                        done.set_exception(error)
+                    else:
+                        self.received += len(part)
+                        done.set_result(None)
+            else:
+                self.received += len(rows)
+                for _, done in batch:
+                    done.set_result(None)
+            async with self._space:
+                self.waiting -= len(rows)
+                self._space.notify_all()
+            for _ in batch:
+                self._queue.task_done()
+
+    def _insert(self, rows):
+        # Devices resend a batch whose answer they missed, replacing keeps that harmless
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO results VALUES (%s)" % ", ".join(
+                "?" * (len(FIELDS) + 2)), rows)
+
+
+async def serve(host, port, path):
+    collector = Collector(path)
+    server = await collector.start(host, port)
+    print("Collecting on %s:%d into %s" % (host, port, path))
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collects test results uploaded by KalEYEdoscope units")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--database", default="collected.db")
+    arguments = parser.parse_args()
+    try:
+        asyncio.run(serve(arguments.host, arguments.port, arguments.database))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# -*- coding:UTF-8 -*-
+"""
+Reads the data file of older versions: a YAML snapshot (data/data) plus an append-only journal of changes
+(data/data.journal). Results are kept in store.py now, this is only used to import and analyse that data.
+"""
+
+import json
+import os
+
+import yaml
+
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def apply(data, path, value):
+    """
+    Sets data[path[0]][path[1]]... to value. An index one past the end of a list appends to it.
+    """
+    target = data
+    for key in path[:-1]:
+        if isinstance(target, dict) and target.get(key) is None:
+            target[key] = {}
+        target = target[key]
+    key = path[-1]
+    if isinstance(target, list) and key == len(target):
+        target.append(value)
+    else:
+        target[key] = value
+
+
+def read(path):
+    """
+    Reads the snapshot and replays the journal (<path>.journal) on top of it, leaving both files as they are.
+    A torn record at the end of the journal is ignored.
+    :return: data dict
+    """
+    with open(path) as snapshot:
+        data = yaml.load(snapshot, Loader=SafeLoader) or {}
+    journal_path = path + ".journal"
+    if os.path.exists(journal_path):
+        with open(journal_path, "rb") as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                apply(data, record[0], record[1])
+    return data
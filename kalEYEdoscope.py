@@ -1,14 +1,21 @@
-import math
+import time
+
+STARTUP_TIME = time.time()
+
 import random
 import sys
+import threading
+from collections import namedtuple
+
+if "-s" in sys.argv:
+    import startup
+
+    startup.watch_imports()
 
-import matplotlib
+if "-p" in sys.argv:
+    import profiler
 
-matplotlib.use('pdf')
-import matplotlib.pyplot as plt
-import numpy as np
-import yaml
-from pylab import sin
+from cache import LRUCache
 
 # DEFINE CONSTANT VARIABLES
 
@@ -17,8 +24,28 @@ WIDTH = 128
 HEIGHT = 128
 BUTTON1 = 14
 BUTTON2 = 15
+BUTTON_BOUNCETIME = 50
+# Milliseconds to hold the OLED in reset and to wait after, the SSD1351 needs a few microseconds
+OLED_RESET_DELAY = 10
+FRAME_CACHE_SIZE = 16 * 1024 * 1024
+SPRITE_CACHE_SIZE = 1024 * 1024
+# Seconds the circle is shown for, counted from when it is completely on the screen
+EXPOSURE_TIME = 0.5
+# Frames that can be queued for the OLED writer thread at once, and whether a newer frame replaces a queued one
+DISPLAY_BUFFERS = 2
+DISPLAY_LATEST_WINS = False
+# Seconds the title fades in for, and a screen change slides or fades for, on the OLED screen
+TITLE_FADE_TIME = 0.6
+TRANSITION_TIME = 0.25
 INTYPE = "BUTTON"
 DISPLAYTYPE = "OLED"
+STARTUP_REPORT = False
+PROFILE = False
+BAYESIAN = False
+# Whose results are read and saved, chosen with -u <name>
+USER = "default"
+# Collector (collector.py) finished tests are uploaded to, (host, port) given with -r <host>:<port>
+COLLECTOR = None
 
 # Interpret command-line arguments
 if len(sys.argv) > 1:
@@ -28,13 +55,17 @@ if len(sys.argv) > 1:
         HEIGHT = 384
         import pygame
         import os
-        import operator
     else:
-        import RPi.GPIO as GPIO
+        if "-v" in sys.argv:
+            import os
+
+            os.environ["OLED_VIRTUAL"] = "1"
         import OLED_Driver as OLED
-        import Image
-        import ImageDraw
-        import ImageFont
+        from buttons import Buttons, QUIT
+        from pipeline import DisplayPipeline
+
+        GPIO = OLED.GPIO
+        from PIL import ImageFont
     if "-c" in sys.argv:
         INTYPE = "SHELL"
     if "-k" in sys.argv:
@@ -42,23 +73,24 @@ if len(sys.argv) > 1:
             print("Error, keyboard must be used with default computer display")
             exit(1)
         INTYPE = "KEYBOARD"
+    STARTUP_REPORT = "-s" in sys.argv
+    PROFILE = "-p" in sys.argv
+    BAYESIAN = "-b" in sys.argv
+    if "-u" in sys.argv and sys.argv.index("-u") + 1 < len(sys.argv):
+        USER = sys.argv[sys.argv.index("-u") + 1]
+    if "-r" in sys.argv and sys.argv.index("-r") + 1 < len(sys.argv):
+        host, _, port = sys.argv[sys.argv.index("-r") + 1].rpartition(":")
+        COLLECTOR = (host, int(port))
 
 
 # DEFINE CONSTANT FUNCTIONS
 
 def get_input():
-    quit_count = 0
     if INTYPE == "BUTTON":
-        while True:
-            if GPIO.input(BUTTON1) == GPIO.HIGH and GPIO.input(BUTTON2) == GPIO.HIGH:
-                if quit_count == 2:
-                    program_quit()
-                OLED.Delay(1000)
-                quit_count += 1
-            elif GPIO.input(BUTTON1) == GPIO.HIGH:
-                return 1
-            elif GPIO.input(BUTTON2) == GPIO.HIGH:
-                return 2
+        button = buttons.wait()
+        if button == QUIT:
+            program_quit()
+        return button
     elif INTYPE == "SHELL":
         while True:
             if sys.version_info[0] < 3:
@@ -70,167 +102,367 @@ def get_input():
             if i == "2": return 2
     elif INTYPE == "KEYBOARD":
         while True:
-            for e in pygame.event.get():
-                if e.type == pygame.KEYDOWN:
-                    if e.key == pygame.K_UP: return 1
-                    if e.key == pygame.K_DOWN: return 2
-                    if e.key == pygame.K_q: program_quit()
-
-
-def clear_screen():
+            # Sleeps until one of the allowed events arrives
+            e = pygame.event.wait()
+            if e.type == pygame.KEYDOWN:
+                if e.key == pygame.K_UP: return 1
+                if e.key == pygame.K_DOWN: return 2
+                if e.key == pygame.K_q: program_quit()
+            elif e.type == pygame.QUIT:
+                program_quit()
+            elif e.type == pygame.VIDEOEXPOSE:
+                pygame.display.flip()
+
+
+def update(frame=None, transition=None):
     """
-    Clears the screen by filling with background
+    :param frame: RGB565 frame to show on the OLED screen
+    :param transition: "slide up", "slide down" or "fade" to animate the change on the OLED screen, the frame
+                       must not change afterwards
     """
     if DISPLAYTYPE == "OLED":
-        OLED.Clear_Screen()
-        clear_image = Image.new("RGB", (OLED.SSD1351_WIDTH, OLED.SSD1351_HEIGHT), "DIMGREY")
-        clear_draw = ImageDraw.Draw(clear_image)
-        return clear_draw, clear_image
+        if loader is None:
+            # Title fade in, the first frame is sent with the contrast down
+            display.call(OLED.Set_Contrast, 0)
+            ticket = display.submit(frame)
+            display.call(OLED.Fade, 0, OLED.CONTRAST_LEVELS - 1, TITLE_FADE_TIME)
+        elif transition:
+            if transition == "fade":
+                display.call(OLED.Fade_To_Frame, frame, TRANSITION_TIME)
+            else:
+                display.call(OLED.Slide_To_Frame, frame, TRANSITION_TIME, transition == "slide up")
+            # Input is taken once the animations are over, so a circle never waits behind one
+            display.fence()
+        else:
+            display.submit(frame)
     elif DISPLAYTYPE == "HDMI":
-        screen.fill(color_background)
-        return None, None
+        global circle_replaced_at
+        if circle_replaced_at is None:
+            # Same clock as pipeline.clock, which is not loaded yet for the first frame
+            circle_replaced_at = time.perf_counter()
+        pygame.display.flip()
+    if loader is None:
+        if DISPLAYTYPE == "OLED":
+            display.fence(ticket)
+        first_frame_shown()
 
 
-def update(update_image=None):
+def load_deferred():
+    """
+    Loads what the start screen does not need, in the background while it is displayed
+    """
+    global stimulus, Staircase, BayesianStaircase, store, user, uploader, prefetcher, clock, wait_until, bank
+    import stimulus
+    from pipeline import clock, wait_until
+    from store import Store
+    from prefetch import Prefetcher
+    from staircase import Staircase, BayesianStaircase
+
+    # With -p the commits on the store thread are timed, queueing a change costs next to nothing
+    store = Store("data/kaleyedoscope.db", timer=(lambda commit: profiler.timed("save", commit)) if PROFILE else None)
+    # Results of older versions are imported into the default user the first time
+    store.migrate_yaml("data/data", "default")
+    # Only the user row is read, past tests stay in the database until asked for
+    user = store.user(USER)
+    if COLLECTOR:
+        from uploader import Uploader
+
+        uploader = Uploader(COLLECTOR[0], COLLECTOR[1])
+    prefetcher = Prefetcher(render_frame)
     if DISPLAYTYPE == "OLED":
-        OLED.Display_Image(update_image)
-    elif DISPLAYTYPE == "HDMI":
-        pygame.display.flip()
+        from stimulus_bank import BANK_PATH, StimulusBank
 
+        try:
+            bank = StimulusBank(BANK_PATH, WIDTH, HEIGHT, crosshair=2)
+        except IOError:
+            pass
+        except ValueError as error:
+            print("Stimulus bank not used: %s, rebuild it with \"python stimulus_bank.py\"" % error)
+    if STARTUP_REPORT:
+        startup.mark("deferred loading")
 
-def update_data():
+
+def first_frame_shown():
     """
-    Saves current data to file
+    Starts loading the rest of the program once the first screen is up
     """
-    with open('data/data', "w") as save_data:
-        yaml.dump(data, save_data)
+    global loader
+    if STARTUP_REPORT:
+        startup.mark("first frame")
+    loader = threading.Thread(target=load_deferred, name="loader")
+    loader.daemon = True
+    loader.start()
+
+
+def wait_loaded():
+    loader.join()
+    if STARTUP_REPORT and startup.marks[-1][0] == "deferred loading":
+        startup.report(STARTUP_TIME)
+        startup.record("data/startup.log", DISPLAYTYPE, STARTUP_TIME)
+        startup.mark("report")
 
 
-def update_buttons(left, right, title=None, subtitle=None, update_draw=None, update_image=None):
+def render_frame(key):
     """
-    Updates the text displayed for each button instruction
-    :param update_image:
-    :param update_draw:
-    :param subtitle: text to be displayed just below title
-    :param title: text to be displayed above option buttons
-    :param left: text to be displayed for the left button
-    :param right: text to be displayed for the right button
+    Renders the ready to send frame for a quantized circle key
+    :return: RGB565 frame on the OLED screen, pygame surface otherwise
     """
+    angle, b, phi, r = stimulus.unquantize(key)
     if DISPLAYTYPE == "OLED":
-        right_text = update_draw.textsize(right, font=font_normal)
-        left_text = update_draw.textsize(left, font=font_normal)
+        # Circle and center cross hair are rendered straight into the frame
+        circle = stimulus.render_circle(angle, b, phi, r, WIDTH, HEIGHT, crosshair=2)
+        return OLED.Coverage_To_RGB565(circle)
+    else:
+        circle = stimulus.render_circle(angle, b, phi, r, WIDTH, HEIGHT, crosshair=5)
+        return pygame.surfarray.make_surface(stimulus.to_rgb(circle).swapaxes(0, 1))
 
-        update_draw.rectangle([(WIDTH // 2 - right_text[0] // 2 - padding, HEIGHT // 2),
-                               (WIDTH // 2 + right_text[0] // 2 + padding, HEIGHT // 2 + right_text[1] + padding)],
-                              fill="BLUE")
 
-        update_draw.rectangle([(WIDTH // 2 - left_text[0] // 2 - padding, HEIGHT * 3 // 4),
-                               (WIDTH // 2 + left_text[0] // 2 + padding, HEIGHT * 3 // 4 + left_text[1] + padding)],
-                              fill="DARKORANGE")
+def frame_size(frame):
+    if DISPLAYTYPE == "OLED":
+        return frame.nbytes
+    return frame.get_width() * frame.get_height() * frame.get_bytesize()
 
-        update_draw.text((WIDTH // 2 - right_text[0] // 2, HEIGHT // 2), right, font=font_normal)
-        update_draw.text((WIDTH // 2 - left_text[0] // 2, HEIGHT * 3 // 4), left, font=font_normal)
 
-        if title:
-            title_text = update_draw.textsize(title, font_subtitle)
-            update_draw.text((WIDTH // 2 - title_text[0] // 2, padding), title, font=font_subtitle)
+def circle_frame(angle, b, phi, r):
+    """
+    Returns the ready to send frame for a circle, from the stimulus bank when it has the circle, otherwise
+    rendering it only when it is neither cached nor prefetched
+    """
+    if bank is not None and bank.covers(angle, b, phi, r):
+        return bank.frame(angle, b, phi, r)
+    key = stimulus.quantize(angle, b, phi, r)
+    frame = prefetcher.take(key)
+    if frame is None:
+        frame = frame_cache.get(key)
+    if frame is None:
+        frame = render_frame(key)
+    frame_cache.put(key, frame, frame_size(frame))
+    return frame
+
+
+def prefetch_circles(candidates, r):
+    """
+    Starts rendering the circles the next trial may show while the user answers
+    :param candidates: angles the next trial may use, for each answer
+    :param r: circle radius
+    """
+    global next_shape
+    next_shape = (random.randint(5, 8), stimulus.random_phase())
+    keys = set()
+    for angles in candidates.values():
+        for angle in angles:
+            if bank is not None and bank.covers(angle, next_shape[0], next_shape[1], r):
+                continue
+            key = stimulus.quantize(angle, next_shape[0], next_shape[1], r)
+            if key not in frame_cache:
+                keys.add(key)
+    prefetcher.submit(keys)
 
-        if subtitle:
-            subtitle_text = update_draw.textsize(subtitle, font_subtitle)
-            update_draw.text((WIDTH // 2 - subtitle_text[0] // 2, subtitle_text[1] + padding * 2), subtitle,
-                             font=font_subtitle)
 
-        update(update_image)
-        button = get_input()
-        if button == 1:
-            update_draw.rectangle([(WIDTH // 2 - right_text[0] // 2 - padding, HEIGHT // 2),
-                                   (WIDTH // 2 + right_text[0] // 2 + padding, HEIGHT // 2 + right_text[1] + padding)],
-                                  outline="BLACK")
-            update(update_image)
-            return 1
-        if button == 2:
-            update_draw.rectangle([(WIDTH // 2 - left_text[0] // 2 - padding, HEIGHT * 3 // 4),
-                                   (
-                                       WIDTH // 2 + left_text[0] // 2 + padding,
-                                       HEIGHT * 3 // 4 + left_text[1] + padding)],
-                                  outline="BLACK")
-            update(update_image)
-            return 2
+# Rendered text or button tile: OLED.Canvas or pygame surface, its RGB565 frame on the OLED screen (None
+# otherwise), the (width, height) of the tile and the size measured for the text in it
+Sprite = namedtuple("Sprite", ["image", "frame", "size", "text_size"])
 
-    elif DISPLAYTYPE == "HDMI":
-        right_text = font_normal.render(right, True, color_white)
-        left_text = font_normal.render(left, True, color_white)
-        right_surface = pygame.Surface(tuple(map(operator.add, font_normal.size(right), (5, 5))))
-        left_surface = pygame.Surface(tuple(map(operator.add, font_normal.size(left), (7, 7))))
-        right_surface.fill(color_background)
-        left_surface.fill(color_background)
 
-        pygame.draw.rect(right_surface, color_right, right_surface.get_rect())
-        pygame.draw.rect(left_surface, color_left, left_surface.get_rect())
+def sprite_size(sprite):
+    if DISPLAYTYPE == "OLED":
+        return sprite.frame.nbytes
+    return sprite.size[0] * sprite.size[1] * sprite.image.get_bytesize()
+
+
+def text_sprite(text, font, color):
+    """
+    Returns text rendered in color, on the background on the OLED screen and transparent otherwise
+    """
+    key = ("text", text, font, color)
+    sprite = sprite_cache.get(key)
+    if sprite is None:
+        if DISPLAYTYPE == "OLED":
+            text_size = font.getsize(text)
+            tile = OLED.Text_Tile(text, font, color, color_background, text_size)
+            sprite = Sprite(tile, tile.frame, text_size, text_size)
+        else:
+            image = font.render(text, True, color)
+            sprite = Sprite(image, None, image.get_size(), font.size(text))
+        sprite_cache.put(key, sprite, sprite_size(sprite))
+    return sprite
+
+
+def button_sprite(text, color, margin, selected=False):
+    """
+    Returns a button instruction: its text on a box filled with color, outlined in black when selected
+    :param margin: pixels added to the width and height of the text on the computer display
+    """
+    key = ("button", text, color, margin, selected)
+    sprite = sprite_cache.get(key)
+    if sprite is None:
+        if DISPLAYTYPE == "OLED":
+            text_size = font_normal.getsize(text)
+            size = (text_size[0] // 2 * 2 + padding * 2 + 1, text_size[1] + padding + 1)
+            tile = OLED.Text_Tile(text, font_normal, color_white, color, size, (padding, 0))
+            if selected:
+                tile.Draw_Rect(0, 0, size[0], size[1], OLED.BLACK)
+            sprite = Sprite(tile, tile.frame, size, text_size)
+        else:
+            text_size = font_normal.size(text)
+            image = pygame.Surface((text_size[0] + margin, text_size[1] + margin))
+            image.fill(color)
+            if selected:
+                pygame.draw.rect(image, color_black, image.get_rect(), 2)
+            label = text_sprite(text, font_normal, color_white).image
+            image.blit(label, (image.get_width() // 2 - label.get_width() // 2,
+                               image.get_height() // 2 - label.get_height() // 2))
+            sprite = Sprite(image, None, image.get_size(), text_size)
+        sprite_cache.put(key, sprite, sprite_size(sprite))
+    return sprite
+
 
-        right_surface.blit(right_text, (right_surface.get_width() // 2 - right_text.get_width() // 2,
-                                        right_surface.get_height() // 2 - right_text.get_height() // 2))
-        left_surface.blit(left_text, (left_surface.get_width() // 2 - left_text.get_width() // 2,
-                                      left_surface.get_height() // 2 - left_text.get_height() // 2))
+# Composed static screen: RGB565 frame on the OLED screen or pygame surface, and the (x, y, width, height)
+# boxes of the right and left buttons
+Template = namedtuple("Template", ["image", "right", "left"])
 
-        screen.blit(right_surface, (WIDTH // 2 - right_surface.get_width() // 2, HEIGHT // 2))
-        screen.blit(left_surface, (WIDTH // 2 - left_surface.get_width() // 2, HEIGHT * 3 // 4))
+
+def compose_screen(left, right, title=None, subtitle=None, heading=None):
+    """
+    Composes a screen with the button instructions from the sprites
+    :return: Template
+    """
+    if DISPLAYTYPE == "OLED":
+        canvas = OLED.Canvas(WIDTH, HEIGHT, OLED.Color565(*color_background))
+        if heading:
+            heading(canvas)
+        right_button = button_sprite(right, color_right, 0)
+        left_button = button_sprite(left, color_left, 0)
+        right_position = (WIDTH // 2 - right_button.text_size[0] // 2 - padding, HEIGHT // 2)
+        left_position = (WIDTH // 2 - left_button.text_size[0] // 2 - padding, HEIGHT * 3 // 4)
+        canvas.Blit(right_position[0], right_position[1], right_button.image)
+        canvas.Blit(left_position[0], left_position[1], left_button.image)
 
         if title:
-            title_text = font_title.render(title, True, color_white)
-            screen.blit(title_text, (WIDTH // 2 - title_text.get_width() // 2, title_text.get_height()))
+            title_text = text_sprite(title, font_subtitle, color_white)
+            canvas.Blit(WIDTH // 2 - title_text.size[0] // 2, padding, title_text.image)
 
         if subtitle:
-            subtitle_text = font_title.render(subtitle, True, color_white)
-            screen.blit(subtitle_text, (WIDTH // 2 - subtitle_text.get_width() // 2,
-                                        subtitle_text.get_height() * 2 + padding))
+            subtitle_text = text_sprite(subtitle, font_subtitle, color_white)
+            canvas.Blit(WIDTH // 2 - subtitle_text.size[0] // 2, subtitle_text.size[1] + padding * 2,
+                        subtitle_text.image)
+        image = canvas.frame
+
+    elif DISPLAYTYPE == "HDMI":
+        image = pygame.Surface((WIDTH, HEIGHT))
+        image.fill(color_background)
+        if heading:
+            heading(image)
+        right_button = button_sprite(right, color_right, 5)
+        left_button = button_sprite(left, color_left, 7)
+        right_position = (WIDTH // 2 - right_button.size[0] // 2, HEIGHT // 2)
+        left_position = (WIDTH // 2 - left_button.size[0] // 2, HEIGHT * 3 // 4)
+        image.blit(right_button.image, right_position)
+        image.blit(left_button.image, left_position)
+
+        if title:
+            title_text = text_sprite(title, font_title, color_white)
+            image.blit(title_text.image, (WIDTH // 2 - title_text.size[0] // 2, title_text.size[1]))
+
+        if subtitle:
+            subtitle_text = text_sprite(subtitle, font_title, color_white)
+            image.blit(subtitle_text.image, (WIDTH // 2 - subtitle_text.size[0] // 2,
+                                             subtitle_text.size[1] * 2 + padding))
+
+    return Template(image, right_position + right_button.size, left_position + left_button.size)
 
-        update()
-        button = get_input()
-        if button == 1:
-            pygame.draw.rect(right_surface, color_black, right_surface.get_rect(), 2)
-            right_surface.blit(right_text, (right_surface.get_width() // 2 - right_text.get_width() // 2,
-                                            right_surface.get_height() // 2 - right_text.get_height() // 2))
-            screen.blit(right_surface, (WIDTH // 2 - right_surface.get_width() // 2, HEIGHT // 2))
 
-            update()
-            pygame.time.delay(100)
-            return 1
-        if button == 2:
-            pygame.draw.rect(left_surface, color_black, left_surface.get_rect(), 2)
-            left_surface.blit(left_text, (left_surface.get_width() // 2 - left_text.get_width() // 2,
-                                          left_surface.get_height() // 2 - left_text.get_height() // 2))
-            screen.blit(left_surface, (WIDTH // 2 - left_surface.get_width() // 2, HEIGHT * 3 // 4))
+def screen_template(left, right, title=None, subtitle=None, heading=None):
+    """
+    Returns a screen that is the same every time it is shown, composing it only the first time
+    """
+    key = (left, right, title, subtitle, heading)
+    template = templates.get(key)
+    if template is None:
+        template = compose_screen(left, right, title, subtitle, heading)
+        templates[key] = template
+    return template
+
+
+def update_buttons(left, right, title=None, subtitle=None, heading=None, transition=None):
+    """
+    Displays the button instructions and waits for the user to pick one
+    :param left: text to be displayed for the left button
+    :param right: text to be displayed for the right button
+    :param title: text to be displayed above option buttons
+    :param subtitle: text to be displayed just below title
+    :param heading: function drawing the rest of the screen, called once with the screen image
+    :param transition: animation of the change to this screen, see update
+    :return: button pressed
+    """
+    template = screen_template(left, right, title, subtitle, heading)
+    if DISPLAYTYPE == "OLED":
+        update(frame=template.image, transition=transition)
+    elif DISPLAYTYPE == "HDMI":
+        screen.blit(template.image, (0, 0))
+        update()
 
-            update()
-            pygame.time.delay(100)
-            return 2
+    button = get_input()
+    if button not in (1, 2):
+        return None
+    # Only the selected button changes, outline it on top of the template
+    box = template.right if button == 1 else template.left
+    if DISPLAYTYPE == "OLED":
+        display.call(OLED.Draw_Rect, box[0], box[1], box[2], box[3], OLED.BLACK)
+    elif DISPLAYTYPE == "HDMI":
+        if button == 1:
+            selected = button_sprite(right, color_right, 5, selected=True)
+        else:
+            selected = button_sprite(left, color_left, 7, selected=True)
+        screen.blit(selected.image, box[:2])
+        update()
+        pygame.time.delay(100)
+    return button
 
 
 # INITIALIZATION
 
+if STARTUP_REPORT:
+    startup.mark("imports")
+
 # Start display
 
 if DISPLAYTYPE == "OLED":
-    OLED.Device_Init()
+    OLED.Device_Init(reset_delay=OLED_RESET_DELAY)
+    # From here on only the writer thread talks to the OLED
+    display = DisplayPipeline(OLED.Display_Frame, (HEIGHT, WIDTH), ">u2", DISPLAY_BUFFERS, DISPLAY_LATEST_WINS)
 elif DISPLAYTYPE == "HDMI":
     os.environ['SDL_VIDEO_CENTERED'] = '1'
     pygame.init()
     size = WIDTH, HEIGHT
     pygame.display.set_caption("KalEYEdoscope")
     screen = pygame.display.set_mode(size, pygame.NOFRAME)
-    clock = pygame.time.Clock()
+    # Only queue the events get_input handles, so waiting for input does not wake up for anything else
+    pygame.event.set_blocked(None)
+    pygame.event.set_allowed([pygame.KEYDOWN, pygame.QUIT, pygame.VIDEOEXPOSE])
+
+if STARTUP_REPORT:
+    startup.mark("display init")
 
 # Initialize buttons
 
 if INTYPE == "BUTTON":
-    GPIO.setup(BUTTON1, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-    GPIO.setup(BUTTON2, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+    buttons = Buttons(GPIO, [BUTTON1, BUTTON2], bouncetime=BUTTON_BOUNCETIME)
 
-# Load frequently used variables
+# Load frequently used variables, the rest is loaded by load_deferred after the first frame
 
-data = yaml.safe_load(open("data/data"))
+loader = None
 state = "Start"
+# Whether the next test is the baseline test
+recording_baseline = False
+frame_cache = LRUCache(FRAME_CACHE_SIZE)
+# Memory-mapped stimulus_bank.StimulusBank, when one was built for this screen
+bank = None
+sprite_cache = LRUCache(SPRITE_CACHE_SIZE)
+templates = {}
+next_shape = None
+# When the first HDMI flip after a circle started, from pipeline.clock, None until it did
+circle_replaced_at = None
 
 # Fonts
 if DISPLAYTYPE == "OLED":
@@ -242,6 +474,9 @@ else:
     font_subtitle = pygame.font.Font(None, 48)
     font_normal = pygame.font.Font(None, 66)
 
+if STARTUP_REPORT:
+    startup.mark("fonts")
+
 # Spacings
 padding = 2
 
@@ -256,41 +491,33 @@ color_left = (255, 140, 0)
 
 # ACTIVITY FUNCTIONS
 
+def draw_welcome(image):
+    """
+    Draws the welcome heading of the start screen
+    :param image: OLED.Canvas on the OLED screen, pygame surface otherwise
+    """
+    if DISPLAYTYPE == "OLED":
+        welcome_text = text_sprite("Welcome to your", font_subtitle, color_black)
+        title_text = text_sprite("KalEYEdoscope", font_subtitle, color_black)
+        image.Blit(WIDTH // 2 - welcome_text.size[0] // 2, welcome_text.size[1], welcome_text.image)
+        image.Blit(WIDTH // 2 - title_text.size[0] // 2, welcome_text.size[1] * 2 + padding, title_text.image)
+    else:
+        text = text_sprite("Welcome to your", font_title, color_white)
+        text2 = text_sprite("KalEYEdoscope", font_title, color_white)
+        image.blit(text.image, (WIDTH // 2 - text.size[0] // 2, text.size[1]))
+        image.blit(text2.image, (WIDTH // 2 - text2.size[0] // 2, text.size[1] * 2 + padding))
+
+
 def start():
     """"
     Main screen event.
     """
     global state
-    if DISPLAYTYPE == "OLED":
-        draw, image = clear_screen()
-        welcome = "Welcome to your"
-        title = "KalEYEdoscope"
-        welcome_text = draw.textsize(welcome, font_subtitle)
-        title_text = draw.textsize(title, font_subtitle)
-        draw.text((WIDTH // 2 - welcome_text[0] // 2, welcome_text[1]), welcome, font=font_subtitle, fill="BLACK")
-        draw.text((WIDTH // 2 - title_text[0] // 2, welcome_text[1] * 2 + padding), title, font=font_subtitle,
-                  fill="BLACK")
-
-        button = update_buttons("Exit", "Start", update_draw=draw, update_image=image)
-
-    else:
-        clear_screen()
-        text = font_title.render("Welcome to your", True, color_white)
-        surface = pygame.Surface(font_title.size("Welcome to your"))
-        surface.fill(color_background)
-        surface.blit(text, (0, 0))
-        text2 = font_title.render("KalEYEdoscope", True, color_white)
-        surface2 = pygame.Surface(font_title.size("KalEYEdoscope"))
-        surface2.fill(color_background)
-        surface2.blit(text2, (0, 0))
-        screen.blit(surface, (WIDTH // 2 - text.get_width() // 2, text.get_height()))
-        screen.blit(surface2, (WIDTH // 2 - text2.get_width() // 2, text.get_height() * 2 + padding))
-        update()
-        button = update_buttons("Exit", "Start")
-        update()
+    button = update_buttons("Exit", "Start", heading=draw_welcome, transition="slide down")
 
+    wait_loaded()
     if button == 1:
-        if data["new_user"]:
+        if not user["baseline_done"]:
             state = "Baseline"
         else:
             state = "Test"
@@ -303,69 +530,56 @@ def baseline():
     """
     Record a baseline test event.
     """
-    global state
-    draw, image = clear_screen()
-
-    data["new_user"] = False
-    data["tests"] = {"0": None}
-    data["number_of_tests"] = -1
-    update_data()
+    global state, recording_baseline
+    store.set_baseline_done(user["id"])
+    user["baseline_done"] = 1
+    recording_baseline = True
 
-    update_buttons("Start", "Start", "Record a ", "baseline.", draw, image)
+    update_buttons("Start", "Start", "Record a ", "baseline.", transition="slide up")
     state = "Test"
 
 
-def display_circle(angle, theta, r):
+def display_circle(angle, r, candidates=None):
     """
-    Displays a circle for half a second, then prompts the user to answer whether the circle is distorted.
+    Displays a circle for EXPOSURE_TIME, then prompts the user to answer whether the circle is distorted.
     :param angle: angle of the circle
-    :param theta: theta for the circle
     :param r: circle radius
-    :return: user's selection
+    :param candidates: angles the next trial may use, rendered while the user answers
+    :return: user's selection, and the angle (quantized to stimulus.ANGLE_STEP), bumps and phase shown (the
+             phase in radians, reduced to the first equivalent one), the requested exposure,
+             the measured exposure and the time it took for the circle to be on the screen, in seconds
     """
-    tan = math.tan(math.radians(angle))
-    if tan != 0:
-        slope = 1 / tan
+    if next_shape:
+        b, phi = next_shape
     else:
-        slope = 99999
-    b = random.randint(5, 8)
-    phi = random.random() * 2 * np.pi
-    distortions = [r / (slope * 5), r / (slope * 6), r / (slope * 7), r / (slope * 8)]
-    rho = r + distortions[b - 5] * sin(b * (theta + phi))
-    plt.polar(theta, rho, linewidth=2, color='w')
-    ax = plt.gca()
-    ax.grid(False)
-    ax.set_rmax(6)
-    ax.set_yticklabels([])
-    ax.set_xticklabels([])
-    ax.spines['polar'].set_visible(False)
-    plt.gcf().savefig('images/current_circle.png', bbox_inches='tight', dpi=(WIDTH // 4), transparent=True,
-                      facecolor='k')
-    plt.close(plt.gcf())
+        b = random.randint(5, 8)
+        phi = stimulus.random_phase()
+    frame = circle_frame(angle, b, phi, r)
+    # The bank only has circles the renderer draws, both show the quantized parameters
+    shown_angle, _, shown_phi, _ = stimulus.unquantize(stimulus.quantize(angle, b, phi, r))
 
+    requested = clock()
     if DISPLAYTYPE == "OLED":
-        circle_image = Image.open("images/current_circle.png", mode='r')
-        draw = ImageDraw.Draw(circle_image)
-        # Center cross hair
-        draw.line((WIDTH // 2, HEIGHT // 2 - 2, WIDTH // 2, HEIGHT // 2 + 2))
-        draw.line((WIDTH // 2 - 2, HEIGHT // 2, WIDTH // 2 + 2, HEIGHT // 2))
-
-        OLED.Clear_Screen()
-        update(circle_image)
-        OLED.Delay(500)
+        ticket = display.submit(frame)
+        display.watch(ticket)
+        onset = display.fence(ticket)
     elif DISPLAYTYPE == "HDMI":
-        circle = pygame.image.load("images/current_circle.png")
-        clear_screen()
-        screen.blit(circle, (WIDTH // 2 - circle.get_width() // 2,
-                             HEIGHT // 2 - circle.get_height() // 2))
-        pygame.draw.line(screen, color_white, (WIDTH // 2, HEIGHT // 2 - 5), (WIDTH // 2, HEIGHT // 2 + 5))
-        pygame.draw.line(screen, color_white, (WIDTH // 2 - 5, HEIGHT // 2), (WIDTH // 2 + 5, HEIGHT // 2))
+        screen.blit(frame, (0, 0))
         update()
-        pygame.time.delay(500)
-        clear_screen()
-
-    draw, image = clear_screen()
-    button = update_buttons("No", "Yes", "Was that a", "perfect circle?", draw, image)
+        onset = clock()
+        global circle_replaced_at
+        circle_replaced_at = None
+
+    if candidates:
+        prefetch_circles(candidates, r)
+    wait_until(onset + EXPOSURE_TIME)
+    # The prompt starts replacing the circle right away, screen templates are ready to send
+    button = update_buttons("No", "Yes", "Was that a", "perfect circle?")
+    # The circle was on the screen until the prompt started to be sent
+    if DISPLAYTYPE == "OLED":
+        offset = display.replaced(ticket)
+    else:
+        offset = circle_replaced_at
 
     # Note that choice returns "y" for a distorted circle and "n" for a normal circle
     if button == 1:
@@ -375,18 +589,19 @@ def display_circle(angle, theta, r):
     else:
         choice = "error"
 
-    return choice
+    return choice, {"angle": round(shown_angle, 4), "bumps": b, "phase": round(shown_phi, 4),
+                    "exposure": EXPOSURE_TIME, "actual_exposure": round(offset - onset, 4),
+                    "latency": round(onset - requested, 4)}
 
 
 def test():
     """
     Test event
     """
-    global state
+    global state, recording_baseline
 
     # Pick eye
-    draw, image = clear_screen()
-    button = update_buttons("Left", "Right", "Select an eye", "to test.", draw, image)
+    button = update_buttons("Left", "Right", "Select an eye", "to test.", transition="slide up")
     eye = "Error"
 
     if button == 1:
@@ -394,81 +609,59 @@ def test():
     elif button == 2:
         eye = "R"
 
-    # Read user data
-    testnum = str(data["number_of_tests"] + 1)
-    data["tests"][testnum] = {}
-    data["number_of_tests"] = data["number_of_tests"] + 1
-    data["tests"][testnum]["eye"] = eye
+    # Record the test
+    testnum = store.next_test_number(user["id"])
+    record = {"user": USER, "number": testnum, "eye": eye, "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "method": "bayesian" if BAYESIAN else "staircase", "baseline": recording_baseline, "trials": []}
+    store.add_test(user["id"], testnum, eye, record["date"], record["method"], recording_baseline)
+    recording_baseline = False
 
     # Calculate Circle Parameters
-    upper_threshold = [15]
-    lower_threshold = [0]
-    current_test = 0
-    threshold_difference = 15
-    convergence = 0.372
-    theta = np.arange(0, 4 * np.pi, 0.01)[1:]
+    if BAYESIAN:
+        staircase = BayesianStaircase()
+    else:
+        staircase = Staircase()
     r = random.randint(3, 5)
-    incorrect_sanity_checks = 0
-    num_sanity_checks = 0
-    while threshold_difference >= 0.75:
-        current_big_t = upper_threshold[current_test]
-        current_small_t = lower_threshold[current_test]
-        # threshold_difference = abs(current_big_t - current_small_t)
-        if random.randint(0, 100) <= 85 or current_test == 0:
-            # Normal Test
-            angle = current_big_t - convergence * threshold_difference
-            choice = display_circle(angle, theta, r)
-            if choice == "y":
-                upper_threshold.append(angle)
-            else:
-                upper_threshold.append(
-                    (current_big_t + min(np.median(upper_threshold), np.mean(upper_threshold))) / 2
-                )
-            angle = current_small_t + convergence * abs(upper_threshold[current_test + 1] - current_small_t)
-            choice = display_circle(angle, theta, r)
-            if choice == "y":
-                lower_threshold.append(
-                    (current_small_t + min(np.median(lower_threshold), np.mean(lower_threshold))) / 2
-                )
-            else:
-                lower_threshold.append(angle)
-        else:
-            # Sanity Check Test
-            num_sanity_checks += 1
-            angle = random.choice([current_big_t, current_small_t])
-            choice = display_circle(angle, theta, r)
-            if choice == "y":
-                upper_threshold.append(current_big_t)
-                if angle == current_small_t:
-                    lower_threshold.append(lower_threshold[current_test - 1])
-                    incorrect_sanity_checks += 1
-                else:
-                    lower_threshold.append(current_small_t)
-            elif choice == "n":
-                lower_threshold.append(current_small_t)
-                if angle == current_small_t:
-                    upper_threshold.append(upper_threshold[current_test - 1])
-                    incorrect_sanity_checks += 1
-                else:
-                    upper_threshold.append(current_big_t)
-
-        current_test += 1
-        current_big_t = upper_threshold[current_test]
-        current_small_t = lower_threshold[current_test]
-        threshold_difference = abs(current_big_t - current_small_t)
-
-    data["tests"][testnum]["lower_thresholds"] = [float(x) for x in lower_threshold]
-    data["tests"][testnum]["upper_thresholds"] = [float(x) for x in upper_threshold]
-    data["tests"][testnum]["check_sanity_num"] = num_sanity_checks
-    data["tests"][testnum]["incorrect_sanity_checks"] = incorrect_sanity_checks
-    update_data()
-
-    draw, image = clear_screen()
-    update_buttons("Start Menu", "Start Menu", "Test Completed", draw, image)
+    while not staircase.done():
+        angle = staircase.next_angle()
+        choice, presentation = display_circle(angle, r, staircase.candidates())
+        staircase.answer(choice)
+        # The angle saved is the one on the screen, not the unquantized one the staircase asked for
+        trial = {"choice": choice}
+        trial.update(presentation)
+        store.add_trial(user["id"], testnum, len(record["trials"]), trial)
+        record["trials"].append(trial)
+
+    record.update({"lower_thresholds": [float(x) for x in staircase.lower_threshold],
+                   "upper_thresholds": [float(x) for x in staircase.upper_threshold],
+                   "check_sanity_num": staircase.num_sanity_checks,
+                   "incorrect_sanity_checks": staircase.incorrect_sanity_checks,
+                   "bayesian": staircase.estimate() if BAYESIAN else None})
+    store.finish_test(user["id"], testnum, record["lower_thresholds"], record["upper_thresholds"],
+                      record["check_sanity_num"], record["incorrect_sanity_checks"], record["bayesian"])
+    if COLLECTOR:
+        uploader.add(record)
+
+    update_buttons("Start Menu", "Start Menu", "Test Completed", transition="fade")
     state = "Start"
 
 
 def program_quit():
+    if loader is not None:
+        wait_loaded()
+        print("Frame cache: " + frame_cache.summary())
+        print("Sprite cache: " + sprite_cache.summary())
+        print("Prefetched frames: " + prefetcher.summary())
+        store.close()
+        if COLLECTOR:
+            uploader.close()
+    if DISPLAYTYPE == "OLED":
+        display.close()
+    if PROFILE:
+        profiler.summary()
+        trace = time.strftime("data/trace-%Y%m%d-%H%M%S.json")
+        profiler.save(trace)
+        print("Trace saved to " + trace)
     if DISPLAYTYPE == "OLED":
         OLED.Clear_Screen()
         GPIO.cleanup()
@@ -477,6 +670,21 @@ def program_quit():
         sys.exit()
 
 
+# Profiling, the hot paths are only wrapped when asked for
+if PROFILE:
+    display_circle = profiler.timed("trial", display_circle)
+    render_frame = profiler.timed("stimulus", render_frame)
+    update_buttons = profiler.timed("screen", update_buttons)
+    text_sprite = profiler.timed("text", text_sprite)
+    button_sprite = profiler.timed("button", button_sprite)
+    get_input = profiler.timed("response", get_input)
+    if DISPLAYTYPE == "OLED":
+        OLED.Coverage_To_RGB565 = profiler.timed("rgb565", OLED.Coverage_To_RGB565)
+        OLED.Draw_Rect = profiler.timed("spi", OLED.Draw_Rect)
+        display.send = profiler.timed("spi", display.send)
+    else:
+        update = profiler.timed("flip", update)
+
 # MAIN RUNNING LOOP
 while True:
     if state == "Start":
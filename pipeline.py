@@ -0,0 +1,172 @@
+# -*- coding:UTF-8 -*-
+"""
+Asynchronous display output: frames are queued to a writer thread that does all the SPI transfers, so
+the next frame can be rendered while the previous one is sent.
+"""
+
+import collections
+import threading
+import time
+
+import numpy as np
+
+# Monotonic high resolution clock used for every display timestamp
+clock = time.perf_counter
+
+
+def wait_until(deadline, spin=0.002):
+    """
+    Sleeps until clock() reaches deadline, busy waiting for the last spin seconds to wake up on time
+    """
+    remaining = deadline - clock()
+    if remaining > spin:
+        time.sleep(remaining - spin)
+    while clock() < deadline:
+        pass
+
+
+class DisplayPipeline(object):
+    """
+    Owns the display while it runs: every frame and drawing call goes through submit or call and is
+    executed in order on the writer thread.
+    Frames are copied into one of a fixed set of buffers. When all of them are in use, submit either
+    waits for one to be sent, or with latest_wins replaces the frame still waiting at the end of the queue.
+    """
+
+    def __init__(self, send, shape, dtype, buffers=2, latest_wins=False):
+        """
+        :param send: function sending one frame to the display, called on the writer thread
+        :param shape: shape of the frames
+        :param dtype: dtype of the frames
+        :param buffers: number of frames that can be queued or in transfer at once
+        :param latest_wins: drop the queued frame that has not started sending instead of waiting for a buffer
+        """
+        self.send = send
+        self.latest_wins = latest_wins
+        self.dropped = 0
+        # Time the last finished item was completely sent, from clock()
+        self.presented_at = None
+        self._free = [np.empty(shape, dtype=dtype) for _ in range(buffers)]
+        # Items are [ticket, function, args, buffer], buffer is None for calls
+        self._queue = collections.deque()
+        self._submitted = 0
+        self._presented = 0
+        # Last ticket the writer started on
+        self._started = 0
+        # Watched tickets and when the item after each of them started, None until it did
+        self._replaced_at = {}
+        self._error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._writer = threading.Thread(target=self._run, name="display")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def submit(self, frame):
+        """
+        Queues a frame and returns without waiting for it to be sent
+        :return: ticket to pass to fence
+        """
+        with self._condition:
+            self._check()
+            while not self._free:
+                if self.latest_wins and self._queue and self._queue[-1][3] is not None:
+                    # Reuse the buffer of the frame nobody will see
+                    self._free.append(self._queue.pop()[3])
+                    self.dropped += 1
+                else:
+                    self._condition.wait()
+                    self._check()
+            buffer = self._free.pop()
+        # Copied outside the lock so the writer keeps sending meanwhile
+        np.copyto(buffer, frame)
+        return self._put(self.send, (buffer,), buffer)
+
+    def call(self, function, *args):
+        """
+        Queues a call to a drawing function, run on the writer thread after what was queued before it
+        :return: ticket to pass to fence
+        """
+        return self._put(function, args, None)
+
+    def fence(self, ticket=None):
+        """
+        Blocks until an item, by default the last one queued, has been sent to the display
+        :return: time it finished sending
+        """
+        with self._condition:
+            if ticket is None:
+                ticket = self._submitted
+            while self._presented < ticket:
+                self._check()
+                self._condition.wait()
+            self._check()
+            return self.presented_at
+
+    def watch(self, ticket):
+        """
+        Records when the writer starts on the item queued after ticket, call before queueing that item
+        """
+        with self._condition:
+            self._replaced_at[ticket] = None
+
+    def replaced(self, ticket):
+        """
+        Blocks until the writer has started on the item after a watched ticket, from then on what ticket put on
+        the display is being overwritten
+        :return: time that item started sending
+        """
+        with self._condition:
+            while self._started <= ticket:
+                self._check()
+                self._condition.wait()
+            self._check()
+            return self._replaced_at.pop(ticket)
+
+    def close(self):
+        """
+        Sends what is queued and stops the writer thread, the display can be used directly afterwards
+        """
+        self.fence()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+
+    def _put(self, function, args, buffer):
+        with self._condition:
+            self._check()
+            self._submitted += 1
+            self._queue.append([self._submitted, function, args, buffer])
+            self._condition.notify_all()
+            return self._submitted
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                ticket, function, args, buffer = self._queue.popleft()
+                self._started = ticket
+                if ticket - 1 in self._replaced_at:
+                    self._replaced_at[ticket - 1] = clock()
+                    self._condition.notify_all()
+            try:
+                function(*args)
+            except Exception as error:
+                with self._condition:
+                    self._error = error
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                if buffer is not None:
+                    self._free.append(buffer)
+                self._presented = ticket
+                self.presented_at = clock()
+                self._condition.notify_all()
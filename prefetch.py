@@ -0,0 +1,83 @@
+# -*- coding:UTF-8 -*-
+"""
+Renders frames that may be needed next on a background thread.
+"""
+
+import queue
+import sys
+import threading
+import traceback
+
+
+class Prefetcher(object):
+    """
+    Speculatively renders a set of candidate frames while the user is answering.
+    Taking one frame discards all the others.
+    """
+
+    def __init__(self, render):
+        """
+        :param render: function rendering the frame for a key, called from the worker thread
+        """
+        self.used = 0
+        self.discarded = 0
+        self._render = render
+        self._queue = queue.Queue()
+        self._lock = threading.Condition()
+        self._wanted = set()
+        self._frames = {}
+        self._rendering = None
+        worker = threading.Thread(target=self._run, name="prefetch")
+        worker.daemon = True
+        worker.start()
+
+    def submit(self, keys):
+        """
+        Replaces the candidates being rendered
+        :param keys: keys of the frames that may be taken next
+        """
+        with self._lock:
+            self._wanted = set(keys)
+            for key in self._wanted:
+                if key not in self._frames:
+                    self._queue.put(key)
+
+    def take(self, key):
+        """
+        Returns the frame rendered for key and drops the other candidates
+        :return: rendered frame, or None if rendering it had not started
+        """
+        with self._lock:
+            while self._rendering == key:
+                self._lock.wait()
+            frame = self._frames.pop(key, None)
+            if frame is not None:
+                self.used += 1
+            self.discarded += len(self._frames)
+            self._frames.clear()
+            self._wanted = set()
+        return frame
+
+    def summary(self):
+        return "%d used, %d discarded" % (self.used, self.discarded)
+
+    def _run(self):
+        while True:
+            key = self._queue.get()
+            with self._lock:
+                if key not in self._wanted or key in self._frames:
+                    continue
+                self._rendering = key
+            frame = None
+            try:
+                frame = self._render(key)
+            except Exception:
+                # take() returns None and the frame is rendered where it is needed, the worker carries on
+                sys.stderr.write("Prefetching %r failed:\n" % (key,))
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._rendering = None
+                    if frame is not None and key in self._wanted:
+                        self._frames[key] = frame
+                    self._lock.notify_all()
@@ -0,0 +1,69 @@
+# -*- coding:UTF-8 -*-
+"""
+Timing of the hot paths, enabled with the -p argument.
+
+Functions are wrapped with timed() only when profiling, so nothing is added to them otherwise. Every call
+is recorded as a span, saved as a Chrome trace (chrome://tracing or ui.perfetto.dev) and summarized on quit.
+"""
+
+import json
+import sys
+import threading
+import time
+
+clock = time.perf_counter
+
+# (name, thread name, start, duration) of every finished call
+spans = []
+session_start = clock()
+
+
+def timed(name, function):
+    """
+    :return: function recording each of its calls as a span called name
+    """
+    def wrapper(*args, **kwargs):
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            spans.append((name, threading.current_thread().name, start, clock() - start))
+
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+def percentile(ordered, fraction):
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+def summary(out=sys.stdout):
+    """
+    Prints the number of calls and the p50, p95 and max duration of each span
+    """
+    durations = {}
+    for name, thread, start, duration in spans:
+        durations.setdefault(name, []).append(duration)
+    out.write("span           calls   p50 [ms]   p95 [ms]   max [ms] total [ms]\n")
+    for name in sorted(durations, key=lambda n: -sum(durations[n])):
+        ordered = sorted(durations[name])
+        out.write("%-12s %7d %10.2f %10.2f %10.2f %10.1f\n" % (
+            name, len(ordered), percentile(ordered, 0.5) * 1000, percentile(ordered, 0.95) * 1000,
+            ordered[-1] * 1000, sum(ordered) * 1000))
+
+
+def save(path):
+    """
+    Writes the spans as complete events of the Chrome trace format, times in microseconds
+    """
+    threads = {}
+    events = []
+    for name, thread, start, duration in spans:
+        tid = threads.setdefault(thread, len(threads))
+        events.append({"name": name, "ph": "X", "pid": 0, "tid": tid,
+                       "ts": int((start - session_start) * 1e6), "dur": int(duration * 1e6)})
+    for thread, tid in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": thread}})
+    with open(path, "w") as trace:
+        json.dump(events, trace, separators=(",", ":"))
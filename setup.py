@@ -7,5 +7,5 @@ setup(
     license='',
     author='Andrew Furman',
     author_email='andrew@efurman.com',
-    description='', install_requires=['matplotlib', 'numpy', 'pygame', 'PyYAML', 'statsmodels', 'pandas']
+    description='', install_requires=['numpy', 'pygame', 'PyYAML', 'statsmodels', 'pandas']
 )
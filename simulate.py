@@ -0,0 +1,241 @@
+# -*- coding:UTF-8 -*-
+"""
+Runs the staircase of test() against simulated observers, without the device.
+
+"python simulate.py --runs 20000 --convergence 0.3 0.372 0.45" compares staircase settings on the same
+simulated observers and reports trials until convergence and the bias and spread of the threshold found.
+Runs are simulated in lockstep with numpy, in chunks spread over a process pool.
+With --bayesian the BayesianStaircase (the -b argument of the app) is simulated instead.
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import random
+
+import numpy as np
+
+from staircase import BayesianStaircase
+
+# Staircase settings, the defaults are the ones test() uses
+DEFAULTS = {"start": 15, "convergence": 0.372, "stop": 0.75, "normal_chance": 85}
+BAYESIAN_DEFAULTS = {"start": 15, "stop": 0.6, "max_trials": 40, "normal_chance": 85}
+
+
+def observers(runs, threshold=(1.0, 6.0), slope=0.5, false_alarm=0.02, lapse=0.02, seed=None):
+    """
+    Draws a population of observers whose chance of seeing a circle with a given distortion angle is
+    false_alarm + (1 - false_alarm - lapse) / (1 + exp((threshold - angle) / slope))
+    :param threshold: (lowest, highest) true threshold in degrees, drawn uniformly
+    :return: dict of arrays with one entry per run
+    """
+    rng = np.random.default_rng(seed)
+    return {"threshold": rng.uniform(threshold[0], threshold[1], runs),
+            "slope": np.full(runs, float(slope)),
+            "false_alarm": np.full(runs, float(false_alarm)),
+            "lapse": np.full(runs, float(lapse))}
+
+
+def seen(observer, angle, draw):
+    """
+    :param draw: uniform random numbers in [0, 1), one per run
+    :return: True where the observer answers that the circle is distorted
+    """
+    with np.errstate(over="ignore"):
+        chance = observer["false_alarm"] + (1 - observer["false_alarm"] - observer["lapse"]) / (
+            1 + np.exp((observer["threshold"] - angle) / observer["slope"]))
+    return draw < chance
+
+
+def simulate(observer, start=15, convergence=0.372, stop=0.75, normal_chance=85, max_rounds=200, seed=None):
+    """
+    Runs the Staircase logic for every observer at once. All runs are at the same round, runs that have
+    converged are left as they are.
+    :param observer: dict of arrays, as returned by observers
+    :param max_rounds: runs still going after this many rounds are reported as not converged
+    :return: dict of arrays with one entry per run: rounds, trials, sanity_checks, incorrect_sanity_checks,
+             final upper and lower thresholds, estimate (their midpoint), converged
+    """
+    rng = np.random.default_rng(seed)
+    runs = len(observer["threshold"])
+    upper = np.full((runs, max_rounds + 1), np.nan)
+    lower = np.full((runs, max_rounds + 1), np.nan)
+    upper[:, 0] = start
+    lower[:, 0] = 0
+    difference = np.full(runs, float(start))
+    rounds = np.zeros(runs, dtype=np.int64)
+    trials = np.zeros(runs, dtype=np.int64)
+    sanity_checks = np.zeros(runs, dtype=np.int64)
+    incorrect = np.zeros(runs, dtype=np.int64)
+
+    for current in range(max_rounds):
+        active = difference >= stop
+        if not active.any():
+            break
+        # Same draws every round whatever is needed: normal or sanity, which threshold to check, two answers
+        normal_draw = rng.integers(0, 101, runs)
+        pick = rng.integers(0, 2, runs)
+        answer_draw = rng.random((2, runs))
+        normal = (normal_draw <= normal_chance) | (current == 0)
+        big = upper[:, current]
+        small = lower[:, current]
+        with np.errstate(invalid="ignore"):
+            # Normal round: a circle near the upper threshold, then one near the lower threshold
+            angle = big - convergence * difference
+            history = upper[:, :current + 1]
+            new_upper = np.where(seen(observer, angle, answer_draw[0]), angle,
+                                 (big + np.minimum(np.median(history, axis=1), np.mean(history, axis=1))) / 2)
+            angle = small + convergence * np.abs(new_upper - small)
+            history = lower[:, :current + 1]
+            new_lower = np.where(seen(observer, angle, answer_draw[1]),
+                                 (small + np.minimum(np.median(history, axis=1), np.mean(history, axis=1))) / 2,
+                                 angle)
+
+            # Sanity check round: a circle at one of the thresholds
+            angle = np.where(pick == 0, big, small)
+            at_small = angle == small
+            distorted = seen(observer, angle, answer_draw[0])
+            if current:
+                sanity_upper = np.where(~distorted & at_small, upper[:, current - 1], big)
+                sanity_lower = np.where(distorted & at_small, lower[:, current - 1], small)
+            else:
+                sanity_upper = sanity_lower = big
+
+        sanity = active & ~normal
+        upper[:, current + 1] = np.where(active, np.where(normal, new_upper, sanity_upper), np.nan)
+        lower[:, current + 1] = np.where(active, np.where(normal, new_lower, sanity_lower), np.nan)
+        rounds += active
+        trials += np.where(sanity, 1, 2) * active
+        sanity_checks += sanity
+        incorrect += sanity & at_small
+        difference = np.where(active, np.abs(upper[:, current + 1] - lower[:, current + 1]), difference)
+
+    index = np.arange(runs)
+    final_upper = upper[index, rounds]
+    final_lower = lower[index, rounds]
+    return {"rounds": rounds, "trials": trials, "sanity_checks": sanity_checks, "incorrect_sanity_checks": incorrect,
+            "upper": final_upper, "lower": final_lower, "estimate": (final_upper + final_lower) / 2,
+            "converged": difference < stop}
+
+
+def simulate_bayesian(observer, start=15, stop=0.6, max_trials=40, normal_chance=85, seed=None):
+    """
+    Runs BayesianStaircase for every observer, one after the other
+    :return: same as simulate
+    """
+    rng = np.random.default_rng(seed)
+    staircase_rng = random.Random(int(rng.integers(2 ** 31)))
+    runs = len(observer["threshold"])
+    result = dict((key, np.zeros(runs, dtype=np.int64))
+                  for key in ("rounds", "trials", "sanity_checks", "incorrect_sanity_checks"))
+    result.update((key, np.zeros(runs)) for key in ("upper", "lower", "estimate"))
+    result["converged"] = np.zeros(runs, dtype=bool)
+    for i in range(runs):
+        single = dict((key, values[i]) for key, values in observer.items())
+        staircase = BayesianStaircase(start, stop, max_trials, normal_chance, rng=staircase_rng)
+        while not staircase.done():
+            angle = staircase.next_angle()
+            staircase.answer("y" if seen(single, angle, rng.random()) else "n")
+        estimate = staircase.estimate()
+        result["rounds"][i] = result["trials"][i] = staircase.trials
+        result["sanity_checks"][i] = staircase.num_sanity_checks
+        result["incorrect_sanity_checks"][i] = staircase.incorrect_sanity_checks
+        result["upper"][i] = staircase.upper_threshold[-1]
+        result["lower"][i] = staircase.lower_threshold[-1]
+        result["estimate"][i] = estimate["threshold"]
+        result["converged"][i] = estimate["threshold_sd"] < stop
+    return result
+
+
+def _simulate_chunk(arguments):
+    method, observer, settings, seed = arguments
+    return method(observer, seed=seed, **settings)
+
+
+def run(observer, settings, processes=None, chunk=2000, seed=None, method=simulate):
+    """
+    Splits the observers into chunks simulated in a process pool
+    :param settings: keyword arguments of method
+    :param method: simulate or simulate_bayesian
+    :return: same as simulate, for all the observers
+    """
+    runs = len(observer["threshold"])
+    starts = range(0, runs, chunk)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    jobs = [(method, dict((key, values[i:i + chunk]) for key, values in observer.items()), settings, seeds[n])
+            for n, i in enumerate(starts)]
+    if processes == 1 or len(jobs) == 1:
+        parts = [_simulate_chunk(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.map(_simulate_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return dict((key, np.concatenate([part[key] for part in parts])) for key in parts[0])
+
+
+def report(settings, observer, result):
+    """
+    :return: one line of the comparison table
+    """
+    trials = result["trials"]
+    error = result["estimate"] - observer["threshold"]
+    converged = result["converged"]
+    return "%6g %8s %6g %5d | %6.1f %5d %5d %6.1f%% | %+7.3f %6.3f %6.3f %7.3f | %5.1f%%" % (
+        settings["start"], "%g" % settings["convergence"] if "convergence" in settings else "max %d" % settings[
+            "max_trials"], settings["stop"], settings["normal_chance"],
+        trials.mean(), np.percentile(trials, 50), np.percentile(trials, 95), 100.0 * converged.mean(),
+        error[converged].mean(), error[converged].std(), np.sqrt((error[converged] ** 2).mean()),
+        np.percentile(np.abs(error[converged]), 95),
+        100.0 * result["incorrect_sanity_checks"].sum() / max(result["sanity_checks"].sum(), 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates the staircase of test() on simulated observers")
+    parser.add_argument("--runs", type=int, default=10000, help="simulated tests per setting")
+    parser.add_argument("--start", type=float, nargs="+", default=[DEFAULTS["start"]])
+    parser.add_argument("--convergence", type=float, nargs="+", default=[DEFAULTS["convergence"]])
+    parser.add_argument("--stop", type=float, nargs="+",
+                        help="gap between the thresholds, or threshold standard deviation with --bayesian, to stop at")
+    parser.add_argument("--bayesian", action="store_true", help="simulate BayesianStaircase instead")
+    parser.add_argument("--max-trials", type=int, nargs="+", default=[BAYESIAN_DEFAULTS["max_trials"]],
+                        help="trials after which BayesianStaircase stops")
+    parser.add_argument("--normal-chance", type=int, nargs="+", default=[DEFAULTS["normal_chance"]])
+    parser.add_argument("--threshold", type=float, nargs=2, default=[1.0, 6.0],
+                        help="range of the true thresholds of the observers, in degrees")
+    parser.add_argument("--slope", type=float, default=0.5, help="spread of the observers' psychometric curve")
+    parser.add_argument("--false-alarm", type=float, default=0.02, help="chance of calling a perfect circle distorted")
+    parser.add_argument("--lapse", type=float, default=0.02, help="chance of missing an obvious distortion")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() if hasattr(os, "cpu_count") else None)
+    parser.add_argument("--seed", type=int, default=1)
+    arguments = parser.parse_args()
+
+    observer = observers(arguments.runs, arguments.threshold, arguments.slope, arguments.false_alarm,
+                         arguments.lapse, arguments.seed)
+    print("%d observers, thresholds %g-%g deg, slope %g, false alarms %g, lapses %g" % (
+        arguments.runs, arguments.threshold[0], arguments.threshold[1], arguments.slope, arguments.false_alarm,
+        arguments.lapse))
+    print(" start converge   stop  norm | trials   p50   p95  conv.  |    bias     sd   rmse  p95|err| | sanity fail")
+    if arguments.bayesian:
+        method = simulate_bayesian
+        combinations = [{"start": start, "stop": stop, "max_trials": max_trials, "normal_chance": normal_chance}
+                        for start, stop, max_trials, normal_chance in itertools.product(
+                            arguments.start, arguments.stop or [BAYESIAN_DEFAULTS["stop"]], arguments.max_trials,
+                            arguments.normal_chance)]
+    else:
+        method = simulate
+        combinations = [{"start": start, "convergence": convergence, "stop": stop, "normal_chance": normal_chance}
+                        for start, convergence, stop, normal_chance in itertools.product(
+                            arguments.start, arguments.convergence, arguments.stop or [DEFAULTS["stop"]],
+                            arguments.normal_chance)]
+    for settings in combinations:
+        # Same observers and random numbers for every setting, so differences come from the settings
+        result = run(observer, settings, arguments.processes, seed=arguments.seed, method=method)
+        print(report(settings, observer, result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+# -*- coding:UTF-8 -*-
+"""
+Adaptive staircase that brackets the smallest circle distortion the user can see.
+"""
+
+import copy
+import random
+
+import numpy as np
+
+
+class Staircase(object):
+    """
+    Moves an upper and a lower threshold angle towards each other until they are closer than stop.
+    Each round shows one circle near each threshold, or a sanity check at one of the thresholds.
+    """
+
+    def __init__(self, start=15, convergence=0.372, stop=0.75, normal_chance=85, rng=random):
+        """
+        :param start: initial upper threshold, the lower one starts at 0
+        :param convergence: fraction of the gap between thresholds to step by
+        :param stop: testing stops once the thresholds are closer than this
+        :param normal_chance: chance out of 100 that a round is a normal test rather than a sanity check
+        :param rng: source of random numbers, the random module by default
+        """
+        self.upper_threshold = [start]
+        self.lower_threshold = [0]
+        self.current_test = 0
+        self.threshold_difference = start
+        self.convergence = convergence
+        self.stop = stop
+        self.normal_chance = normal_chance
+        self.rng = rng
+        self.num_sanity_checks = 0
+        self.incorrect_sanity_checks = 0
+        # None at the start of a round, otherwise the trial being asked or coming next
+        self.pending = None
+        self.angle = None
+
+    def done(self):
+        return self.pending is None and self.threshold_difference < self.stop
+
+    def next_angle(self):
+        """
+        Starts the next trial
+        :return: angle of the circle to display
+        """
+        current_big_t = self.upper_threshold[self.current_test]
+        current_small_t = self.lower_threshold[self.current_test]
+        if self.pending is None:
+            if self.rng.randint(0, 100) <= self.normal_chance or self.current_test == 0:
+                # Normal Test
+                self.pending = "upper"
+                self.angle = current_big_t - self.convergence * self.threshold_difference
+            else:
+                # Sanity Check Test
+                self.pending = "sanity"
+                self.num_sanity_checks += 1
+                self.angle = self.rng.choice([current_big_t, current_small_t])
+        elif self.pending == "lower next":
+            self.pending = "lower"
+            self.angle = self._lower_angle()
+        return self.angle
+
+    def answer(self, choice):
+        """
+        Records the answer to the current trial
+        :param choice: "y" if the user saw a distorted circle, "n" otherwise
+        """
+        upper_threshold = self.upper_threshold
+        lower_threshold = self.lower_threshold
+        current_test = self.current_test
+        current_big_t = upper_threshold[current_test]
+        current_small_t = lower_threshold[current_test]
+        angle = self.angle
+
+        if self.pending == "upper":
+            if choice == "y":
+                upper_threshold.append(angle)
+            else:
+                upper_threshold.append(
+                    (current_big_t + min(np.median(upper_threshold), np.mean(upper_threshold))) / 2
+                )
+            self.pending = "lower next"
+            return
+
+        if self.pending == "lower":
+            if choice == "y":
+                lower_threshold.append(
+                    (current_small_t + min(np.median(lower_threshold), np.mean(lower_threshold))) / 2
+                )
+            else:
+                lower_threshold.append(angle)
+        elif self.pending == "sanity":
+            if choice == "y":
+                upper_threshold.append(current_big_t)
+                if angle == current_small_t:
+                    lower_threshold.append(lower_threshold[current_test - 1])
+                    self.incorrect_sanity_checks += 1
+                else:
+                    lower_threshold.append(current_small_t)
+            elif choice == "n":
+                lower_threshold.append(current_small_t)
+                if angle == current_small_t:
+                    upper_threshold.append(upper_threshold[current_test - 1])
+                    self.incorrect_sanity_checks += 1
+                else:
+                    upper_threshold.append(current_big_t)
+
+        self.current_test += 1
+        self.threshold_difference = abs(upper_threshold[self.current_test] - lower_threshold[self.current_test])
+        self.pending = None
+
+    def candidates(self):
+        """
+        Angles the trial after the current one may use, for each possible answer
+        :return: {"y": [angles], "n": [angles]}
+        """
+        result = {}
+        for choice in ("y", "n"):
+            branch = copy.copy(self)
+            branch.upper_threshold = list(self.upper_threshold)
+            branch.lower_threshold = list(self.lower_threshold)
+            branch.answer(choice)
+            result[choice] = branch._possible_angles()
+        return result
+
+    def _lower_angle(self):
+        current_small_t = self.lower_threshold[self.current_test]
+        return current_small_t + self.convergence * abs(self.upper_threshold[self.current_test + 1] - current_small_t)
+
+    def _possible_angles(self):
+        if self.pending == "lower next":
+            return [self._lower_angle()]
+        if self.done():
+            return []
+        current_big_t = self.upper_threshold[self.current_test]
+        current_small_t = self.lower_threshold[self.current_test]
+        angles = [current_big_t - self.convergence * self.threshold_difference]
+        if self.current_test != 0:
+            for angle in (current_big_t, current_small_t):
+                if angle not in angles:
+                    angles.append(angle)
+        return angles
+
+
+# Likelihood tables shared by the BayesianStaircase instances with the same grids, see _tables
+_table_cache = {}
+
+
+def _tables(start, false_alarm, lapse):
+    """
+    Precomputes, for every angle that can be shown and every (threshold, slope) hypothesis, the chance that
+    the user sees a distorted circle, and the term of the expected entropy that only depends on it
+    :return: angles, thresholds, slopes, chance of "y" and sum of p log p over both answers, as (angles,
+             thresholds * slopes) arrays
+    """
+    key = (start, false_alarm, lapse)
+    if key not in _table_cache:
+        angles = np.arange(0.25, start + 1e-9, 0.25)
+        thresholds = np.arange(0.1, start + 1e-9, 0.1)
+        slopes = np.array([0.25, 0.5, 1.0, 2.0])
+        logistic = 1 / (1 + np.exp((thresholds[None, :, None] - angles[:, None, None]) / slopes[None, None, :]))
+        seen = (false_alarm + (1 - false_alarm - lapse) * logistic).reshape(len(angles), -1)
+        information = seen * np.log(seen) + (1 - seen) * np.log(1 - seen)
+        _table_cache[key] = (angles, thresholds, slopes, seen, information)
+    return _table_cache[key]
+
+
+class BayesianStaircase(object):
+    """
+    Psi method: keeps a posterior over the threshold and slope of the user's psychometric function, and
+    shows the angle whose answer is expected to leave the least uncertainty about them.
+    Has the interface of Staircase, upper_threshold and lower_threshold hold the posterior mean of the
+    threshold plus and minus one standard deviation after each trial.
+    Sanity checks show the most distorted circle, answering that it is perfect counts as incorrect.
+    """
+
+    def __init__(self, start=15, stop=0.6, max_trials=40, normal_chance=85, false_alarm=0.02, lapse=0.02,
+                 rng=random):
+        """
+        :param start: largest angle shown, and of the threshold considered
+        :param stop: testing stops once the standard deviation of the threshold is below this
+        :param max_trials: testing stops after this many trials in any case
+        :param normal_chance: chance out of 100 that a trial is a normal test rather than a sanity check
+        :param false_alarm: assumed chance of calling a perfect circle distorted
+        :param lapse: assumed chance of missing an obvious distortion
+        :param rng: source of random numbers, the random module by default
+        """
+        self.angles, self.thresholds, self.slopes, self.seen, self.information = _tables(start, false_alarm, lapse)
+        self.posterior = np.full(self.seen.shape[1], 1.0 / self.seen.shape[1])
+        self.stop = stop
+        self.max_trials = max_trials
+        self.normal_chance = normal_chance
+        self.rng = rng
+        self.trials = 0
+        self.upper_threshold = [start]
+        self.lower_threshold = [0]
+        self.num_sanity_checks = 0
+        self.incorrect_sanity_checks = 0
+        # None between trials, otherwise "normal" or "sanity" for the trial being asked
+        self.pending = None
+        self.index = None
+        self.angle = None
+
+    def done(self):
+        return self.pending is None and (self.trials >= self.max_trials or self.estimate()["threshold_sd"] < self.stop)
+
+    def next_angle(self):
+        """
+        Starts the next trial
+        :return: angle of the circle to display
+        """
+        if self.pending is None:
+            if self.rng.randint(0, 100) <= self.normal_chance or self.trials == 0:
+                self.pending = "normal"
+                self.index = self._best_index()
+            else:
+                self.pending = "sanity"
+                self.num_sanity_checks += 1
+                self.index = len(self.angles) - 1
+            self.angle = float(self.angles[self.index])
+        return self.angle
+
+    def answer(self, choice):
+        """
+        Records the answer to the current trial
+        :param choice: "y" if the user saw a distorted circle, "n" otherwise
+        """
+        if choice in ("y", "n"):
+            if choice == "y":
+                likelihood = self.seen[self.index]
+            else:
+                likelihood = 1 - self.seen[self.index]
+                if self.pending == "sanity":
+                    self.incorrect_sanity_checks += 1
+            posterior = self.posterior * likelihood
+            self.posterior = posterior / posterior.sum()
+            self.trials += 1
+            estimate = self.estimate()
+            self.upper_threshold.append(estimate["threshold"] + estimate["threshold_sd"])
+            self.lower_threshold.append(max(estimate["threshold"] - estimate["threshold_sd"], 0.0))
+        self.pending = None
+
+    def estimate(self):
+        """
+        :return: posterior mean and standard deviation of the threshold, and posterior mean of the slope
+        """
+        joint = self.posterior.reshape(len(self.thresholds), len(self.slopes))
+        marginal = joint.sum(axis=1)
+        mean = marginal.dot(self.thresholds)
+        variance = marginal.dot((self.thresholds - mean) ** 2)
+        return {"threshold": float(mean), "threshold_sd": float(np.sqrt(variance)),
+                "slope": float(joint.sum(axis=0).dot(self.slopes))}
+
+    def candidates(self):
+        """
+        Angles the trial after the current one may use, for each possible answer
+        :return: {"y": [angles], "n": [angles]}
+        """
+        result = {}
+        for choice in ("y", "n"):
+            branch = copy.copy(self)
+            branch.upper_threshold = list(self.upper_threshold)
+            branch.lower_threshold = list(self.lower_threshold)
+            branch.answer(choice)
+            if branch.done():
+                result[choice] = []
+            else:
+                result[choice] = [float(self.angles[branch._best_index()]), float(self.angles[-1])]
+        return result
+
+    def _best_index(self):
+        # Expected entropy of the posterior after showing each angle, leaving out the terms common to all angles
+        seen = self.seen.dot(self.posterior)
+        expected = -self.information.dot(self.posterior) + seen * np.log(seen) + (1 - seen) * np.log(1 - seen)
+        return int(np.argmin(expected))
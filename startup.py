@@ -0,0 +1,92 @@
+# -*- coding:UTF-8 -*-
+"""
+Startup time measurements, enabled with the -s argument.
+"""
+
+import builtins
+import sys
+import threading
+import time
+
+marks = []
+imports = []
+_original_import = builtins.__import__
+# Nesting of the imports in progress, per thread
+_stack = threading.local()
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if not hasattr(_stack, "children"):
+        _stack.children = [0.0]
+    loaded = len(sys.modules)
+    _stack.children.append(0.0)
+    start = time.time()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        children = _stack.children.pop()
+        _stack.children[-1] += elapsed
+        # Only imports that actually loaded something are worth reporting
+        if len(sys.modules) > loaded:
+            label = "." * level + (name or ", ".join(fromlist or ()))
+            imports.append((len(_stack.children) - 1, label, elapsed - children, elapsed))
+
+
+def watch_imports():
+    """
+    Times every import from now on, like python -X importtime
+    """
+    builtins.__import__ = _timed_import
+
+
+def mark(name):
+    """
+    Records that a startup phase has finished
+    """
+    marks.append((name, time.time()))
+
+
+def process_start():
+    """
+    :return: time the process started (before the interpreter loaded), or None if unknown
+    """
+    try:
+        with open("/proc/self/stat") as stat:
+            started = int(stat.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime:
+            up = float(uptime.read().split()[0])
+        import os
+        return time.time() - up + started / float(os.sysconf("SC_CLK_TCK"))
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def report(script_start, out=sys.stderr, top=15):
+    """
+    Prints the time taken by each startup phase and the slowest imports
+    :param script_start: time the script started executing
+    """
+    process = process_start()
+    if process is not None and process < script_start:
+        out.write("interpreter startup        %8.1f ms\n" % ((script_start - process) * 1000))
+    previous = script_start
+    for name, when in marks:
+        out.write("%-26s %8.1f ms  (%.1f ms since start)\n" % (name, (when - previous) * 1000,
+                                                              (when - script_start) * 1000))
+        previous = when
+    out.write("slowest imports: self [ms] | cumulative [ms] | module\n")
+    for depth, name, own, cumulative in sorted(imports, key=lambda i: -i[3])[:top]:
+        out.write("%8.1f | %8.1f | %s%s\n" % (own * 1000, cumulative * 1000, "  " * depth, name[:60]))
+
+
+def record(path, label, script_start):
+    """
+    Appends the time to first frame to a log file, so it can be tracked across versions
+    """
+    first_frame = dict(marks).get("first frame")
+    if first_frame is None:
+        return
+    with open(path, "a") as log:
+        log.write("%s %s first frame %.3f s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), label,
+                                                  first_frame - script_start))
@@ -0,0 +1,116 @@
+# -*- coding:UTF-8 -*-
+"""
+Renders the distorted circle stimulus straight into a pixel buffer.
+
+The geometry matches the old matplotlib figure: plt.polar with rmax 6, saved with
+bbox_inches='tight' at dpi = width / 4, which puts rmax at 0.462 * width pixels from
+the centre and draws a 2 point wide line.
+"""
+
+import math
+import random
+
+import numpy as np
+
+PLOT_RMAX = 6
+PLOT_RADIUS = 0.462
+LINE_WIDTH = 2
+
+# Stimuli closer than this are drawn identically, so they can share a rendered frame
+ANGLE_STEP = 0.05
+PHASE_STEPS = 64
+
+
+def distortion(angle, b, r):
+    """
+    Amplitude of the sine distortion for a given angle
+    :param angle: angle of the circle, in degrees
+    :param b: number of bumps around the circle
+    :param r: circle radius
+    """
+    tan = math.tan(math.radians(angle))
+    if tan != 0:
+        slope = 1 / tan
+    else:
+        slope = 99999
+    return r / (slope * b)
+
+
+def random_phase(phase_steps=PHASE_STEPS):
+    """
+    Picks a random phase, restricted to phase_steps buckets so that frames can be reused
+    """
+    return random.randrange(phase_steps) * 2 * math.pi / phase_steps
+
+
+def quantize(angle, b, phi, r, angle_step=ANGLE_STEP, phase_steps=PHASE_STEPS):
+    """
+    Maps circle parameters to the key of the frame that displays them
+    :return: (angle index, b, phase index, r)
+    """
+    # Phases a multiple of 2 pi / b apart draw the same circle
+    period = phase_steps // math.gcd(phase_steps, b)
+    phase = int(round(phi * phase_steps / (2 * math.pi))) % period
+    return int(round(angle / angle_step)), b, phase, r
+
+
+def unquantize(key, angle_step=ANGLE_STEP, phase_steps=PHASE_STEPS):
+    """
+    Circle parameters drawn for a key returned by quantize
+    :return: (angle, b, phi, r)
+    """
+    angle, b, phase, r = key
+    return angle * angle_step, b, phase * 2 * math.pi / phase_steps, r
+
+
+def render_circle(angle, b, phi, r, width, height=None, crosshair=2):
+    """
+    Rasterizes rho = r + d * sin(b * (theta + phi)) as an antialiased line
+    :param angle: angle of the circle, in degrees
+    :param b: number of bumps around the circle
+    :param phi: phase of the distortion
+    :param r: circle radius
+    :param width: width of the buffer in pixels
+    :param height: height of the buffer in pixels, defaults to width
+    :param crosshair: half length of the centre crosshair in pixels, 0 for none
+    :return: (height, width) float32 array of line coverage between 0 and 1
+    """
+    if height is None:
+        height = width
+    d = distortion(angle, b, r)
+    scale = PLOT_RADIUS * width / PLOT_RMAX
+    half_line = LINE_WIDTH * (width / 4.0) / 72 / 2
+
+    # Polar coordinates of every pixel centre, in plot units
+    cx = width // 2 + 0.5
+    cy = height // 2 + 0.5
+    x = (np.arange(width, dtype=np.float32) + 0.5 - cx) / scale
+    y = (cy - np.arange(height, dtype=np.float32) - 0.5) / scale
+    x, y = np.meshgrid(x, y)
+    rho = np.hypot(x, y)
+    theta = np.arctan2(y, x)
+
+    # Distance to the curve along the radius, corrected for the local slope of the curve
+    phase = b * (theta + phi)
+    curve = r + d * np.sin(phase)
+    slope = d * b * np.cos(phase) / curve
+    distance = np.abs(rho - curve) * scale / np.sqrt(1 + slope * slope)
+    coverage = np.clip(half_line + 0.5 - distance, 0, 1)
+    # theta used to run over two turns, so every point of the line was drawn twice
+    coverage = (1 - (1 - coverage) ** 2).astype(np.float32)
+
+    if crosshair:
+        coverage[height // 2 - crosshair:height // 2 + crosshair + 1, width // 2] = 1
+        coverage[height // 2, width // 2 - crosshair:width // 2 + crosshair + 1] = 1
+    return coverage
+
+
+def to_rgb(coverage, color=(255, 255, 255), background=(0, 0, 0)):
+    """
+    Blends a coverage buffer into an RGB image
+    :return: (height, width, 3) uint8 array
+    """
+    color = np.asarray(color, dtype=np.float32)
+    background = np.asarray(background, dtype=np.float32)
+    rgb = background + coverage[:, :, None] * (color - background)
+    return (rgb + 0.5).astype(np.uint8)
@@ -0,0 +1,208 @@
+# -*- coding:UTF-8 -*-
+"""
+Every circle the OLED screen can show, rendered ahead of time into one file that the app maps into memory.
+
+"python stimulus_bank.py" renders the bank with a process pool into data/stimuli.bank. When that file exists
+and matches the current screen and circle geometry, display_circle sends frames straight from the mapping
+instead of rendering them. The bank is a subset of the circles of the renderer (stimulus.ANGLE_STEP and
+PHASE_STEPS): every phase and every 0.25 degrees by default, the angles of the Bayesian staircase, in about
+1 GB. Circles off its grid are rendered as before, never rounded to a circle of the bank ("--angle-step 0.05"
+gives every angle, in about 5 GB).
+
+File layout, little endian:
+    header   magic, format and geometry versions, frame size, crosshair, grid (see HEADER)
+    index    int32 frame number for every (r, b, phase, angle index), phases equivalent for b share frames
+    frames   RGB565 frames in panel byte order, starting on a page boundary
+"""
+
+import argparse
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import time
+
+import numpy as np
+
+import stimulus
+
+BANK_PATH = "data/stimuli.bank"
+MAGIC = b"KEYEBANK"
+FORMAT_VERSION = 1
+# Bump whenever stimulus.render_circle draws differently, so older banks are rebuilt
+GEOMETRY_VERSION = 2
+# magic, format version, geometry version, width, height, crosshair, angle step, angle count, phase steps,
+# lowest and highest b, lowest and highest r, plot rmax, plot radius, line width, frame count, index offset,
+# frames offset
+HEADER = struct.Struct("<8sIIHHHdIIBBBBdddIQQ")
+PAGE = 4096
+
+
+class StimulusBank(object):
+    """
+    Read-only view of a bank file, frames are numpy arrays backed by the mapping
+    """
+
+    def __init__(self, path, width, height, crosshair=2):
+        """
+        :raise IOError: the file cannot be read
+        :raise ValueError: the file is not a bank, or was built for another geometry
+        """
+        with open(path, "rb") as bank:
+            self._map = mmap.mmap(bank.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            fields = HEADER.unpack_from(self._map, 0)
+        except struct.error:
+            raise ValueError("%s is not a stimulus bank" % path)
+        (magic, format_version, geometry_version, bank_width, bank_height, bank_crosshair, self.angle_step,
+         self.angle_count, self.phase_steps, self.b_min, self.b_max, self.r_min, self.r_max, plot_rmax, plot_radius,
+         line_width, count, index_offset, frames_offset) = fields
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError("%s is not a stimulus bank of this version" % path)
+        if (geometry_version, bank_width, bank_height, bank_crosshair, plot_rmax, plot_radius, line_width) != (
+                GEOMETRY_VERSION, width, height, crosshair, stimulus.PLOT_RMAX, stimulus.PLOT_RADIUS,
+                stimulus.LINE_WIDTH):
+            raise ValueError("%s was built for another screen or circle geometry" % path)
+        # Bank grid points in renderer grid points, the bank only has circles the renderer draws
+        self.angle_ratio = int(round(self.angle_step / stimulus.ANGLE_STEP))
+        self.phase_ratio = stimulus.PHASE_STEPS // self.phase_steps
+        if (abs(self.angle_ratio * stimulus.ANGLE_STEP - self.angle_step) > 1e-9 or
+                self.phase_ratio * self.phase_steps != stimulus.PHASE_STEPS):
+            raise ValueError("%s was built for another angle and phase grid" % path)
+        if len(self._map) < frames_offset + count * width * height * 2:
+            raise ValueError("%s is truncated" % path)
+        shape = (self.r_max - self.r_min + 1, self.b_max - self.b_min + 1, self.phase_steps, self.angle_count)
+        self.index = np.frombuffer(self._map, dtype="<i4", offset=index_offset,
+                                   count=int(np.prod(shape))).reshape(shape)
+        self.frames = np.frombuffer(self._map, dtype=">u2", offset=frames_offset,
+                                    count=count * width * height).reshape(count, height, width)
+        self.max_angle = (self.angle_count - 1) * self.angle_step
+
+    def covers(self, angle, b, phi, r):
+        """
+        :return: whether the bank has exactly the circle the renderer would draw for these parameters
+        """
+        angle_index, b, phase, r = stimulus.quantize(angle, b, phi, r)
+        return (self.b_min <= b <= self.b_max and self.r_min <= r <= self.r_max and
+                angle_index % self.angle_ratio == 0 and 0 <= angle_index // self.angle_ratio < self.angle_count and
+                phase % self.phase_ratio == 0)
+
+    def frame(self, angle, b, phi, r):
+        """
+        :return: (height, width) '>u2' frame of a circle the bank covers, read-only
+        """
+        angle_index, b, phase, r = stimulus.quantize(angle, b, phi, r)
+        return self.frames[self.index[r - self.r_min, b - self.b_min, phase // self.phase_ratio,
+                                      angle_index // self.angle_ratio]]
+
+    def close(self):
+        self.index = self.frames = None
+        self._map.close()
+
+
+def keys(angle_count, phase_steps, bumps, radii):
+    """
+    :return: (angle index, b, phase, r) of every distinct frame, in the order they are stored
+    """
+    result = []
+    for r in radii:
+        for b in bumps:
+            period = phase_steps // math.gcd(phase_steps, b)
+            for phase in range(period):
+                for angle in range(angle_count):
+                    result.append((angle, b, phase, r))
+    return result
+
+
+def render(arguments):
+    """
+    Renders a chunk of frames in a pool process
+    :return: their RGB565 bytes, one after the other
+    """
+    chunk, angle_ratio, phase_ratio, width, height, crosshair = arguments
+    frames = np.empty((len(chunk), height, width), dtype=">u2")
+    for i, (angle, b, phase, r) in enumerate(chunk):
+        # Same parameters as the renderer for this key, so the frames are identical to rendered ones
+        angle, b, phi, r = stimulus.unquantize((angle * angle_ratio, b, phase * phase_ratio, r))
+        coverage = stimulus.render_circle(angle, b, phi, r, width, height, crosshair=crosshair)
+        rgb = stimulus.to_rgb(coverage).astype(np.uint16)
+        frames[i] = ((rgb[:, :, 0] & 0xF8) << 8) | ((rgb[:, :, 1] & 0xFC) << 3) | (rgb[:, :, 2] >> 3)
+    return frames.tobytes()
+
+
+def build(path=BANK_PATH, width=128, height=128, crosshair=2, angle_step=0.25, max_angle=15,
+          phase_steps=stimulus.PHASE_STEPS, bumps=(5, 8), radii=(3, 5), processes=None, chunk=64):
+    """
+    Renders every frame in a process pool and writes the bank, replacing path atomically
+    :param angle_step: degrees between the angles in the bank, a multiple of stimulus.ANGLE_STEP
+    :param phase_steps: phases in the bank, stimulus.PHASE_STEPS or a divisor of it
+    :param bumps: lowest and highest number of bumps (b) display_circle uses
+    :param radii: lowest and highest radius display_circle uses
+    :return: number of frames
+    :raise ValueError: the angles or phases are not on the grid of the renderer
+    """
+    angle_ratio = int(round(angle_step / stimulus.ANGLE_STEP))
+    if angle_ratio < 1 or abs(angle_ratio * stimulus.ANGLE_STEP - angle_step) > 1e-9:
+        raise ValueError("angle step must be a multiple of %g" % stimulus.ANGLE_STEP)
+    if phase_steps < 1 or stimulus.PHASE_STEPS % phase_steps:
+        raise ValueError("phase steps must divide %d" % stimulus.PHASE_STEPS)
+    angle_count = int(round(max_angle / angle_step)) + 1
+    bump_values = range(bumps[0], bumps[1] + 1)
+    radius_values = range(radii[0], radii[1] + 1)
+    frame_keys = keys(angle_count, phase_steps, bump_values, radius_values)
+
+    index = np.empty((len(radius_values), len(bump_values), phase_steps, angle_count), dtype="<i4")
+    numbers = dict((key, n) for n, key in enumerate(frame_keys))
+    for i, r in enumerate(radius_values):
+        for j, b in enumerate(bump_values):
+            period = phase_steps // math.gcd(phase_steps, b)
+            for phase in range(phase_steps):
+                for angle in range(angle_count):
+                    index[i, j, phase, angle] = numbers[(angle, b, phase % period, r)]
+    index_offset = HEADER.size
+    frames_offset = (index_offset + index.nbytes + PAGE - 1) // PAGE * PAGE
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, GEOMETRY_VERSION, width, height, crosshair, angle_step, angle_count,
+                         phase_steps, bumps[0], bumps[1], radii[0], radii[1], stimulus.PLOT_RMAX,
+                         stimulus.PLOT_RADIUS, stimulus.LINE_WIDTH, len(frame_keys), index_offset, frames_offset)
+
+    jobs = [(frame_keys[i:i + chunk], angle_ratio, stimulus.PHASE_STEPS // phase_steps, width, height, crosshair)
+            for i in range(0, len(frame_keys), chunk)]
+    temp_path = path + ".tmp"
+    pool = multiprocessing.Pool(processes)
+    try:
+        with open(temp_path, "wb") as bank:
+            bank.write(header)
+            bank.write(index.tobytes())
+            bank.seek(frames_offset)
+            # In order, so the frames land where the index points
+            for frames in pool.imap(render, jobs):
+                bank.write(frames)
+            bank.flush()
+            os.fsync(bank.fileno())
+    finally:
+        pool.close()
+        pool.join()
+    os.rename(temp_path, path)
+    return len(frame_keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Renders every circle of the OLED screen into a stimulus bank")
+    parser.add_argument("--output", default=BANK_PATH)
+    parser.add_argument("--angle-step", type=float, default=0.25,
+                        help="degrees between the angles in the bank, a multiple of %g" % stimulus.ANGLE_STEP)
+    parser.add_argument("--max-angle", type=float, default=15, help="largest angle in the bank, in degrees")
+    parser.add_argument("--phase-steps", type=int, default=stimulus.PHASE_STEPS,
+                        help="phases the bumps can start at, a divisor of %d" % stimulus.PHASE_STEPS)
+    parser.add_argument("--processes", type=int, default=None, help="rendering processes, all cores by default")
+    arguments = parser.parse_args()
+    start = time.time()
+    count = build(arguments.output, angle_step=arguments.angle_step, max_angle=arguments.max_angle,
+                  phase_steps=arguments.phase_steps, processes=arguments.processes)
+    print("%d frames, %.1f MB written to %s in %.1f s" % (count, os.path.getsize(arguments.output) / 1e6,
+                                                          arguments.output, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+# -*- coding:UTF-8 -*-
+"""
+Test results of every user in an SQLite database (data/kaleyedoscope.db).
+
+Writes are queued to a background thread that commits them in batches, reads only touch the rows they need
+through the indexes. "python store.py migrate [data file] [user]" imports the YAML data of older versions.
+"""
+
+import json
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    created TEXT NOT NULL,
+    baseline_done INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS tests (
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    number INTEGER NOT NULL,
+    eye TEXT,
+    date TEXT,
+    method TEXT NOT NULL DEFAULT 'staircase',
+    baseline INTEGER NOT NULL DEFAULT 0,
+    finished INTEGER NOT NULL DEFAULT 0,
+    lower_thresholds TEXT,
+    upper_thresholds TEXT,
+    check_sanity_num INTEGER,
+    incorrect_sanity_checks INTEGER,
+    bayesian TEXT,
+    PRIMARY KEY (user_id, number)
+);
+CREATE INDEX IF NOT EXISTS tests_eye_date ON tests (user_id, eye, date);
+CREATE INDEX IF NOT EXISTS tests_date ON tests (user_id, date);
+CREATE INDEX IF NOT EXISTS tests_baseline ON tests (user_id, eye, date) WHERE baseline = 1;
+CREATE TABLE IF NOT EXISTS trials (
+    user_id INTEGER NOT NULL,
+    test INTEGER NOT NULL,
+    number INTEGER NOT NULL,
+    angle REAL NOT NULL,
+    choice TEXT NOT NULL,
+    exposure REAL,
+    actual_exposure REAL,
+    latency REAL,
+    bumps INTEGER,
+    phase REAL,
+    PRIMARY KEY (user_id, test, number)
+);
+CREATE TABLE IF NOT EXISTS migrations (
+    source TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    tests INTEGER NOT NULL
+);
+"""
+
+TEST_COLUMNS = ("number", "eye", "date", "method", "baseline", "finished", "lower_thresholds", "upper_thresholds",
+                "check_sanity_num", "incorrect_sanity_checks", "bayesian")
+TRIAL_COLUMNS = ("angle", "choice", "exposure", "actual_exposure", "latency", "bumps", "phase")
+# Trial columns added after the first version of the database, with their types
+ADDED_TRIAL_COLUMNS = (("bumps", "INTEGER"), ("phase", "REAL"))
+
+
+class StoreError(sqlite3.Error):
+    """
+    Changes the writer could not commit, raised by the next read or flush
+    """
+
+    def __init__(self, failed):
+        """
+        :param failed: list of (sql, parameters, error) of every change that was dropped
+        """
+        sql, parameters, error = failed[0]
+        sqlite3.Error.__init__(self, "%d change(s) not saved, first: %s with %r: %s" % (len(failed), sql, parameters,
+                                                                                      error))
+        self.failed = failed
+
+
+def now():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def connect(path):
+    # Opened by the loader thread and read from the main thread, never from both at once
+    connection = sqlite3.connect(path, check_same_thread=False)
+    # Readers never wait for the writer, and a commit only syncs the write-ahead log
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class Store(object):
+    """
+    Users and their tests and trials. Write methods return straight away, the changes reach the database
+    within batch_delay seconds, and before any read.
+    """
+
+    def __init__(self, path="data/kaleyedoscope.db", batch_delay=0.1, timer=None):
+        """
+        :param path: database file, created if missing
+        :param batch_delay: seconds the writer waits to gather more changes into one commit
+        :param timer: function wrapping the function that commits a batch on the writer thread, to time the
+                      commits (e.g. lambda commit: profiler.timed("save", commit))
+        """
+        self.path = path
+        self.batch_delay = batch_delay
+        self._commit_batch = timer(self._commit) if timer else self._commit
+        self._connection = connect(path)
+        self._connection.executescript(SCHEMA)
+        existing = [row[1] for row in self._connection.execute("PRAGMA table_info(trials)")]
+        for column, kind in ADDED_TRIAL_COLUMNS:
+            if column not in existing:
+                self._connection.execute("ALTER TABLE trials ADD COLUMN %s %s" % (column, kind))
+        self._changes = queue.Queue()
+        # Changes that failed since the last flush, appended by the writer thread
+        self._failed = []
+        self._writer = threading.Thread(target=self._run, name="store")
+        self._writer.daemon = True
+        self._writer.start()
+
+    # Users
+
+    def user(self, name):
+        """
+        Returns a user, creating it the first time
+        :return: dict with the id, name, created and baseline_done columns
+        """
+        self.flush()
+        with self._connection:
+            self._connection.execute("INSERT OR IGNORE INTO users (name, created) VALUES (?, ?)", (name, now()))
+        row = self._connection.execute("SELECT id, name, created, baseline_done FROM users WHERE name = ?",
+                                       (name,)).fetchone()
+        return dict(zip(("id", "name", "created", "baseline_done"), row))
+
+    def set_baseline_done(self, user_id, done=True):
+        self._write("UPDATE users SET baseline_done = ? WHERE id = ?", (int(done), user_id))
+
+    # Writing tests
+
+    def next_test_number(self, user_id):
+        self.flush()
+        row = self._connection.execute("SELECT MAX(number) FROM tests WHERE user_id = ?", (user_id,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def add_test(self, user_id, number, eye, date=None, method="staircase", baseline=False):
+        """
+        Starts a test, its results are added by finish_test
+        """
+        self._write("INSERT INTO tests (user_id, number, eye, date, method, baseline) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, number, eye, date or now(), method, int(baseline)))
+
+    def add_trial(self, user_id, test, number, trial):
+        """
+        :param trial: dict with angle and choice, and optionally exposure, actual_exposure, latency, bumps and
+                      phase
+        """
+        self._write("INSERT OR REPLACE INTO trials (user_id, test, number, %s) VALUES (%s)" % (
+            ", ".join(TRIAL_COLUMNS), ", ".join("?" * (len(TRIAL_COLUMNS) + 3))),
+            (user_id, test, number) + tuple(trial.get(c) for c in TRIAL_COLUMNS))
+
+    def finish_test(self, user_id, number, lower_thresholds, upper_thresholds, check_sanity_num,
+                    incorrect_sanity_checks, bayesian=None):
+        self._write("UPDATE tests SET finished = 1, lower_thresholds = ?, upper_thresholds = ?, check_sanity_num = ?, "
+                    "incorrect_sanity_checks = ?, bayesian = ? WHERE user_id = ? AND number = ?",
+                    (json.dumps([float(x) for x in lower_thresholds]), json.dumps([float(x) for x in upper_thresholds]),
+                     check_sanity_num, incorrect_sanity_checks, json.dumps(bayesian) if bayesian else None,
+                     user_id, number))
+
+    # Reading tests
+
+    def tests(self, user_id, eye=None, before=None, limit=20, finished=None):
+        """
+        Returns one page of tests, latest first. Pass the number of the last test of a page as before to get
+        the next one.
+        :param eye: only tests of this eye
+        :param finished: only finished (True) or unfinished (False) tests
+        :return: list of test dicts, thresholds and bayesian decoded
+        """
+        self.flush()
+        where = ["user_id = ?"]
+        parameters = [user_id]
+        if eye is not None:
+            where.append("eye = ?")
+            parameters.append(eye)
+        if before is not None:
+            where.append("number < ?")
+            parameters.append(before)
+        if finished is not None:
+            where.append("finished = ?")
+            parameters.append(int(finished))
+        rows = self._connection.execute("SELECT %s FROM tests WHERE %s ORDER BY number DESC LIMIT ?" % (
+            ", ".join(TEST_COLUMNS), " AND ".join(where)), parameters + [limit]).fetchall()
+        return [self._test(row) for row in rows]
+
+    def last_baseline(self, user_id, eye):
+        """
+        :return: latest baseline test of an eye, or None
+        """
+        self.flush()
+        row = self._connection.execute(
+            "SELECT %s FROM tests INDEXED BY tests_baseline WHERE user_id = ? AND eye = ? AND baseline = 1 "
+            "ORDER BY date DESC LIMIT 1" % ", ".join(TEST_COLUMNS), (user_id, eye)).fetchone()
+        return self._test(row) if row else None
+
+    def trials(self, user_id, test):
+        self.flush()
+        rows = self._connection.execute("SELECT %s FROM trials WHERE user_id = ? AND test = ? ORDER BY number" %
+                                        ", ".join(TRIAL_COLUMNS), (user_id, test)).fetchall()
+        return [dict(zip(TRIAL_COLUMNS, row)) for row in rows]
+
+    def _test(self, row):
+        test = dict(zip(TEST_COLUMNS, row))
+        for column in ("lower_thresholds", "upper_thresholds", "bayesian"):
+            if test[column] is not None:
+                test[column] = json.loads(test[column])
+        return test
+
+    # Migration
+
+    def migrate_yaml(self, path, name):
+        """
+        Imports the data file of older versions (YAML snapshot and journal) for a user, once
+        :return: number of tests imported, None if the file was imported before or does not exist
+        """
+        import os
+        import journal
+
+        self.flush()
+        if not os.path.exists(path) or self._connection.execute(
+                "SELECT 1 FROM migrations WHERE source = ?", (path,)).fetchone():
+            return None
+        data = journal.read(path)
+        user = self.user(name)
+        count = 0
+        with self._connection:
+            if data.get("new_user") is False:
+                self._connection.execute("UPDATE users SET baseline_done = 1 WHERE id = ?", (user["id"],))
+            for key, test in sorted((data.get("tests") or {}).items(), key=lambda item: int(item[0])):
+                if not test:
+                    continue
+                number = int(key)
+                finished = bool(test.get("upper_thresholds"))
+                # The test recorded right after the baseline screen was always number 0
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO tests (user_id, %s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" %
+                    ", ".join(TEST_COLUMNS),
+                    (user["id"], number, test.get("eye"), test.get("date"), test.get("method") or "staircase",
+                     int(number == 0), int(finished),
+                     json.dumps(test["lower_thresholds"]) if finished else None,
+                     json.dumps(test["upper_thresholds"]) if finished else None,
+                     test.get("check_sanity_num"), test.get("incorrect_sanity_checks"),
+                     json.dumps(test["bayesian"]) if test.get("bayesian") else None))
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO trials (user_id, test, number, %s) VALUES (%s)" % (
+                        ", ".join(TRIAL_COLUMNS), ", ".join("?" * (len(TRIAL_COLUMNS) + 3))),
+                    [(user["id"], number, i) + tuple(trial.get(c) for c in TRIAL_COLUMNS)
+                     for i, trial in enumerate(test.get("trials") or [])])
+                count += 1
+            self._connection.execute("INSERT INTO migrations (source, date, tests) VALUES (?, ?, ?)",
+                                     (path, now(), count))
+        return count
+
+    # Writer
+
+    def flush(self):
+        """
+        Blocks until every change so far is committed
+        :raise StoreError: some changes since the last flush could not be committed, the others were
+        """
+        self._changes.join()
+        if self._failed:
+            failed, self._failed = self._failed, []
+            raise StoreError(failed)
+
+    def close(self):
+        if self._writer is not None:
+            self.flush()
+            self._connection.close()
+            self._writer = None
+
+    def _write(self, sql, parameters):
+        self._changes.put((sql, parameters))
+
+    def _run(self):
+        connection = connect(self.path)
+        while True:
+            batch = [self._changes.get()]
+            time.sleep(self.batch_delay)
+            while True:
+                try:
+                    batch.append(self._changes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit_batch(connection, batch)
+            finally:
+                for _ in batch:
+                    self._changes.task_done()
+
+    def _commit(self, connection, batch):
+        """
+        Commits a batch of changes in one transaction, on the writer thread
+        """
+        try:
+            with connection:
+                for sql, parameters in batch:
+                    connection.execute(sql, parameters)
+        except sqlite3.Error:
+            # The whole batch was rolled back, commit the changes one by one so only the bad ones are lost.
+            # Those are raised by the next read or flush, instead of dying silently on this thread
+            for sql, parameters in batch:
+                try:
+                    with connection:
+                        connection.execute(sql, parameters)
+                except sqlite3.Error as error:
+                    self._failed.append((sql, parameters, error))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("usage: python store.py migrate [data file] [user]")
+        sys.exit(1)
+    source = sys.argv[2] if len(sys.argv) > 2 else "data/data"
+    imported = Store().migrate_yaml(source, sys.argv[3] if len(sys.argv) > 3 else "default")
+    if imported is None:
+        print("%s was imported before or does not exist" % source)
+    else:
+        print("Imported %d tests from %s" % (imported, source))
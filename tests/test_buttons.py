@@ -0,0 +1,57 @@
+# -*- coding:UTF-8 -*-
+import threading
+import time
+import unittest
+
+from buttons import Buttons, QUIT
+from virtual_panel import VirtualGPIO
+
+LEFT = 14
+RIGHT = 15
+
+
+def later(seconds, function, *args):
+    timer = threading.Timer(seconds, function, args)
+    timer.start()
+    return timer
+
+
+class ButtonsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gpio = VirtualGPIO(None, 25, 24, 8)
+        self.buttons = Buttons(self.gpio, [LEFT, RIGHT], bouncetime=50, quit_hold=0.3)
+
+    def test_single_press_returns_right_away(self):
+        pressed = []
+        later(0.02, lambda: (pressed.append(time.monotonic()), self.gpio.press(RIGHT)))
+        self.assertEqual(self.buttons.wait(), 2)
+        self.assertLess(time.monotonic() - pressed[0], 0.01)
+
+    def test_both_pressed_a_few_ms_apart_and_held_quits(self):
+        later(0.02, self.gpio.press, LEFT)
+        later(0.03, self.gpio.press, RIGHT)
+        # The first press is taken as it comes, the second one turns the next wait into a quit
+        self.assertEqual(self.buttons.wait(), 1)
+        self.assertEqual(self.buttons.wait(), QUIT)
+        self.assertGreaterEqual(time.monotonic() - self.buttons._pressed_at[RIGHT], 0.3)
+
+    def test_second_button_after_the_first_was_returned_quits(self):
+        later(0.02, self.gpio.press, LEFT)
+        self.assertEqual(self.buttons.wait(), 1)
+        self.gpio.press(RIGHT)
+        # The edge of the right button is cleared, both being held is what counts
+        self.assertEqual(self.buttons.wait(), QUIT)
+
+    def test_both_released_early_waits_for_the_next_press(self):
+        later(0.02, self.gpio.press, LEFT)
+        later(0.03, self.gpio.press, RIGHT)
+        later(0.1, self.gpio.release, LEFT)
+        later(0.1, self.gpio.release, RIGHT)
+        later(0.2, self.gpio.press, LEFT)
+        later(0.25, self.gpio.release, LEFT)
+        self.assertEqual(self.buttons.wait(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
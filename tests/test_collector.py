@@ -0,0 +1,124 @@
+# -*- coding:UTF-8 -*-
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from collector import Collector
+from uploader import Uploader
+
+
+def record(number, user="test", **fields):
+    result = {"user": user, "number": number, "eye": "L", "date": "2026-10-18 10:00:00", "method": "staircase",
+              "baseline": False, "lower_thresholds": [0, 1.5], "upper_thresholds": [15, 2.5],
+              "check_sanity_num": 1, "incorrect_sanity_checks": 0, "trials": [{"angle": 3.0, "choice": "y"}]}
+    result.update(fields)
+    return result
+
+
+async def send(port, device, records, read_answer=True):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write((json.dumps({"device": device, "records": records}) + "\n").encode("utf-8"))
+    await writer.drain()
+    answer = json.loads((await reader.readline()).decode("utf-8")) if read_answer else None
+    writer.close()
+    return answer
+
+
+class CollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "collected.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def count(self, where="1"):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute("SELECT COUNT(*) FROM results WHERE %s" % where).fetchone()[0]
+        finally:
+            connection.close()
+
+    def collect(self, clients):
+        """
+        Runs the collector on a free port while the clients coroutine talks to it
+        :return: what clients returned
+        """
+        async def run():
+            collector = Collector(self.path, batch_delay=0.02)
+            server = await collector.start("127.0.0.1", 0)
+            try:
+                return await clients(server.sockets[0].getsockname()[1])
+            finally:
+                await collector.close()
+
+        return asyncio.run(run())
+
+    def test_concurrent_clients(self):
+        async def clients(port):
+            return await asyncio.gather(*[send(port, "d%d" % i, [record(n) for n in range(5)]) for i in range(50)])
+
+        self.assertEqual(self.collect(clients), [{"ok": 5}] * 50)
+        self.assertEqual(self.count(), 250)
+
+    def test_bad_record_only_fails_its_own_batch(self):
+        async def clients(port):
+            return await asyncio.gather(send(port, "a", [record(0)]), send(port, "b", [{"user": "test"}]),
+                                        send(port, "c", [record(0, check_sanity_num=2 ** 70)]))
+
+        good, missing_number, too_large = self.collect(clients)
+        self.assertEqual(good, {"ok": 1})
+        self.assertIn("refused", missing_number)
+        self.assertIn("refused", too_large)
+        self.assertEqual(self.count(), 1)
+
+    def test_resend_after_lost_answer(self):
+        async def clients(port):
+            await send(port, "a", [record(0), record(1)], read_answer=False)
+            return await send(port, "a", [record(0), record(1)])
+
+        self.assertEqual(self.collect(clients), {"ok": 2})
+        self.assertEqual(self.count(), 2)
+
+    def test_uploader_sets_refused_records_aside(self):
+        spool = os.path.join(self.directory, "upload.spool")
+        started = threading.Event()
+        stop = threading.Event()
+        ports = []
+
+        async def clients(port):
+            ports.append(port)
+            started.set()
+            while not stop.is_set():
+                await asyncio.sleep(0.02)
+
+        thread = threading.Thread(target=self.collect, args=(clients,))
+        thread.start()
+        started.wait()
+        uploader = Uploader("127.0.0.1", ports[0], spool, device="kiosk", batch_size=10)
+        try:
+            for number in range(3):
+                uploader.add(record(number) if number != 1 else {"user": "test"})
+            deadline = time.time() + 10
+            while uploader.pending() and time.time() < deadline:
+                time.sleep(0.02)
+            self.assertEqual((uploader.pending(), uploader.uploaded, uploader.refused), (0, 2, 1))
+        finally:
+            uploader.close()
+            stop.set()
+            thread.join()
+        self.assertEqual(self.count("device = 'kiosk'"), 2)
+        with open(spool + ".refused") as refused:
+            lines = [json.loads(line) for line in refused]
+        self.assertEqual([line["record"] for line in lines], [{"user": "test"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
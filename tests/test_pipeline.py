@@ -0,0 +1,28 @@
+# -*- coding:UTF-8 -*-
+import time
+import unittest
+
+import numpy as np
+
+from pipeline import DisplayPipeline, clock
+
+
+class DisplayPipelineTest(unittest.TestCase):
+
+    def test_replaced_is_when_the_next_item_starts(self):
+        sent = []
+        display = DisplayPipeline(lambda frame: sent.append(clock()), (2, 2), ">u2")
+        ticket = display.submit(np.zeros((2, 2), dtype=">u2"))
+        display.watch(ticket)
+        shown = display.fence(ticket)
+        time.sleep(0.05)
+        queued = clock()
+        display.call(lambda: time.sleep(0.02))
+        replaced = display.replaced(ticket)
+        self.assertGreaterEqual(replaced, queued)
+        self.assertGreaterEqual(replaced - shown, 0.05)
+        display.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+# -*- coding:UTF-8 -*-
+import threading
+import unittest
+
+from prefetch import Prefetcher
+
+
+class PrefetcherTest(unittest.TestCase):
+
+    def test_failed_render_does_not_block_take(self):
+        started = {"bad": threading.Event(), "good": threading.Event()}
+        release = threading.Event()
+
+        def render(key):
+            started[key].set()
+            if key == "bad":
+                release.wait()
+                raise RuntimeError("render failed")
+            return key.upper()
+
+        prefetcher = Prefetcher(render)
+        prefetcher.submit(["bad"])
+        started["bad"].wait(1)
+        threading.Timer(0.05, release.set).start()
+        # Waits for the render in progress, which fails
+        self.assertIsNone(prefetcher.take("bad"))
+        # The worker is still alive
+        prefetcher.submit(["good"])
+        self.assertTrue(started["good"].wait(1))
+        self.assertEqual(prefetcher.take("good"), "GOOD")
+
+
+if __name__ == "__main__":
+    unittest.main()
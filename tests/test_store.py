@@ -0,0 +1,60 @@
+# -*- coding:UTF-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from store import Store, StoreError
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = Store(os.path.join(self.directory, "test.db"), batch_delay=0.05)
+        self.user = self.store.user("test")
+
+    def tearDown(self):
+        self.store._connection.close()
+        shutil.rmtree(self.directory)
+
+    def test_failed_change_keeps_the_rest_of_its_batch(self):
+        self.store.add_test(self.user["id"], 0, "L")
+        self.store.add_trial(self.user["id"], 0, 0, {"angle": 1.0, "choice": "y"})
+        # Same primary key as the test above
+        self.store.add_test(self.user["id"], 0, "R")
+        self.store.add_trial(self.user["id"], 0, 1, {"angle": 2.0, "choice": "n"})
+        with self.assertRaises(StoreError) as raised:
+            self.store.flush()
+        self.assertEqual(len(raised.exception.failed), 1)
+        self.assertIn("INSERT INTO tests", str(raised.exception))
+        self.assertEqual([trial["angle"] for trial in self.store.trials(self.user["id"], 0)], [1.0, 2.0])
+        self.assertEqual(self.store.tests(self.user["id"])[0]["eye"], "L")
+
+    def test_failure_is_raised_once(self):
+        self.store.add_test(self.user["id"], 0, "L")
+        self.store.add_test(self.user["id"], 0, "L")
+        self.assertRaises(StoreError, self.store.flush)
+        self.store.flush()
+        self.assertEqual(self.store.next_test_number(self.user["id"]), 1)
+
+    def test_timer_wraps_the_commits(self):
+        commits = []
+
+        def timer(commit):
+            def timed(connection, batch):
+                commits.append(len(batch))
+                return commit(connection, batch)
+            return timed
+
+        store = Store(os.path.join(self.directory, "timed.db"), batch_delay=0.05, timer=timer)
+        user = store.user("test")
+        store.add_test(user["id"], 0, "L")
+        store.add_trial(user["id"], 0, 0, {"angle": 1.0, "choice": "y"})
+        store.flush()
+        self.assertEqual(commits, [2])
+        store._connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+# -*- coding:UTF-8 -*-
+"""
+Uploads finished tests to a collector (collector.py), enabled with the -r <host>:<port> argument.
+
+Records are appended to a spool file first, so they survive restarts and network outages, and a background
+thread sends them in batches, one batch waiting for its answer at a time. A batch the collector refuses is sent
+again one record at a time, and the records it refuses are moved to <spool>.refused instead of being retried.
+"""
+
+import json
+import os
+import socket
+import threading
+
+
+class Refused(Exception):
+    """
+    The collector will never accept the batch, sending it again does not help
+    """
+
+
+class Uploader(object):
+    """
+    Keeps the records not yet acknowledged by the collector in <spool>, the number of bytes of it already
+    acknowledged is kept in <spool>.sent
+    """
+
+    def __init__(self, host, port, spool="data/upload.spool", device=None, batch_size=100, timeout=10,
+                 max_backoff=60):
+        """
+        :param device: name of this unit in the collected results, the host name by default
+        :param batch_size: most records sent at once
+        :param timeout: seconds to wait for the collector before trying again
+        :param max_backoff: longest wait in seconds between attempts while the collector cannot be reached
+        """
+        self.address = (host, port)
+        self.spool_path = spool
+        self.sent_path = spool + ".sent"
+        self.refused_path = spool + ".refused"
+        self.device = device or socket.gethostname()
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.uploaded = 0
+        self.refused = 0
+        self._sent = 0
+        # Records before this offset are sent one at a time, to find the ones in a refused batch
+        self._single_until = 0
+        if os.path.exists(self.sent_path):
+            with open(self.sent_path) as sent:
+                self._sent = int(sent.read() or 0)
+        if os.path.exists(self.spool_path):
+            with open(self.spool_path, "r+b") as spool:
+                content = spool.read()
+                if not content.endswith(b"\n"):
+                    # Torn write at the end, drop it so new records start on a fresh line
+                    spool.truncate(content.rfind(b"\n") + 1)
+        size = os.path.getsize(self.spool_path) if os.path.exists(self.spool_path) else 0
+        if self._sent > size:
+            # The spool was started over but the offset not, nothing of the new spool was sent yet
+            self._sent = 0
+        self._socket = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="uploader")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, record):
+        """
+        Spools a record for upload, it is on disk when this returns
+        """
+        with self._condition:
+            with open(self.spool_path, "a") as spool:
+                spool.write(json.dumps(record) + "\n")
+                spool.flush()
+                os.fsync(spool.fileno())
+            self._condition.notify_all()
+
+    def pending(self):
+        """
+        :return: number of bytes of records not acknowledged yet
+        """
+        with self._condition:
+            size = os.path.getsize(self.spool_path) if os.path.exists(self.spool_path) else 0
+            return size - self._sent
+
+    def close(self):
+        """
+        Stops uploading, what was not acknowledged is sent on the next start
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(self.timeout)
+
+    def _batch(self):
+        """
+        :return: complete lines after the acknowledged ones, at most batch_size of them, and their size in bytes
+        """
+        lines = []
+        size = 0
+        limit = 1 if self._sent < self._single_until else self.batch_size
+        with open(self.spool_path, "rb") as spool:
+            spool.seek(self._sent)
+            for line in spool:
+                if not line.endswith(b"\n") or len(lines) == limit:
+                    break
+                lines.append(line.decode("utf-8"))
+                size += len(line)
+        return lines, size
+
+    def _acknowledged(self, size):
+        with self._condition:
+            self._sent += size
+            if self._sent >= os.path.getsize(self.spool_path):
+                # Everything is uploaded, start the spool over instead of letting it grow. The offset is reset
+                # first: a crash in between resends records the collector replaces, rather than skipping new ones
+                self._save_sent(0)
+                open(self.spool_path, "w").close()
+                self._sent = self._single_until = 0
+            else:
+                self._save_sent(self._sent)
+
+    def _save_sent(self, sent_bytes):
+        temp_path = self.sent_path + ".tmp"
+        with open(temp_path, "w") as sent:
+            sent.write(str(sent_bytes))
+            sent.flush()
+            os.fsync(sent.fileno())
+        os.rename(temp_path, self.sent_path)
+
+    def _set_aside(self, line, reason):
+        """
+        Keeps a refused record in <spool>.refused with the reason, instead of blocking the ones after it
+        """
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = line.rstrip("\n")
+        with open(self.refused_path, "a") as refused:
+            refused.write(json.dumps({"reason": reason, "record": record}) + "\n")
+            refused.flush()
+            os.fsync(refused.fileno())
+
+    def _send(self, lines):
+        if self._socket is None:
+            self._socket = socket.create_connection(self.address, self.timeout)
+            self._answers = self._socket.makefile("rb")
+        message = '{"device": %s, "records": [%s]}\n' % (json.dumps(self.device),
+                                                       ", ".join(line.rstrip("\n") for line in lines))
+        self._socket.sendall(message.encode("utf-8"))
+        answer = self._answers.readline()
+        if not answer:
+            raise IOError("collector closed the connection")
+        answer = json.loads(answer.decode("utf-8"))
+        if "refused" in answer:
+            raise Refused(answer["refused"])
+        if "ok" not in answer:
+            raise IOError("collector could not store the batch: %s" % answer.get("error"))
+
+    def _disconnect(self):
+        if self._socket is not None:
+            try:
+                self._answers.close()
+                self._socket.close()
+            except (IOError, OSError):
+                pass
+            self._socket = None
+
+    def _run(self):
+        backoff = 1
+        while True:
+            with self._condition:
+                while not self._closed and self.pending() <= 0:
+                    self._condition.wait()
+                if self._closed:
+                    break
+                lines, size = self._batch()
+            try:
+                self._send(lines)
+            except Refused as error:
+                if len(lines) > 1:
+                    # Find the records it refuses by sending them one at a time
+                    self._single_until = self._sent + size
+                else:
+                    self._set_aside(lines[0], str(error))
+                    self._acknowledged(size)
+                    self.refused += 1
+                continue
+            except (IOError, OSError, ValueError):
+                self._disconnect()
+                with self._condition:
+                    self._condition.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = 1
+            self._acknowledged(size)
+            self.uploaded += len(lines)
+        self._disconnect()
@@ -0,0 +1,340 @@
+# -*- coding:UTF-8 -*-
+"""
+Software SSD1351 panel with stand-ins for RPi.GPIO and spidev, so the OLED driver and the OLED
+screens of the app run, and can be measured, without a Raspberry Pi.
+
+OLED_Driver uses it when the OLED_VIRTUAL environment variable is set (kalEYEdoscope.py -v).
+"""
+
+import time
+
+import numpy as np
+
+WIDTH = 128
+HEIGHT = 128
+
+# Number of parameter bytes taken by each command, commands missing here take none
+PARAMETERS = {
+    0x15: 2,  # SETCOLUMN
+    0x75: 2,  # SETROW
+    0xA0: 1,  # SETREMAP
+    0xA1: 1,  # STARTLINE
+    0xA2: 1,  # DISPLAYOFFSET
+    0xAB: 1,  # FUNCTIONSELECT
+    0xB1: 1,  # PRECHARGE
+    0xB2: 3,  # DISPLAYENHANCE
+    0xB3: 1,  # CLOCKDIV
+    0xB4: 3,  # SETVSL
+    0xB5: 1,  # SETGPIO
+    0xB6: 1,  # PRECHARGE2
+    0xB8: 63,  # SETGRAY
+    0xBB: 1,  # PRECHARGELEVEL
+    0xBE: 1,  # VCOMH
+    0xC1: 3,  # CONTRASTABC
+    0xC7: 1,  # CONTRASTMASTER
+    0xCA: 1,  # MUXRATIO
+    0xFD: 1,  # COMMANDLOCK
+    0x96: 5,  # HORIZSCROLL
+}
+
+
+class VirtualPanel(object):
+    """
+    Interprets the byte stream sent to an SSD1351 and keeps its display RAM.
+    Only the commands the driver uses have an effect, every other one is recorded and ignored.
+    """
+
+    def __init__(self, speed_hz=9000000, realtime=False):
+        """
+        :param speed_hz: SPI clock used to estimate bus time
+        :param realtime: make every write take as long as it would on the bus
+        """
+        self.speed_hz = speed_hz
+        self.realtime = realtime
+        # Display RAM, one 16 bit word per pixel, as received (high byte first)
+        self.ram = np.zeros((HEIGHT, WIDTH), dtype=np.uint16)
+        self.pins = {"cs": 1, "dc": 0, "rst": 1}
+        self.reset()
+        self.reset_stats()
+
+    def reset(self):
+        """
+        Puts the registers back to their power on values
+        """
+        self.column = [0, WIDTH - 1]
+        self.row = [0, HEIGHT - 1]
+        self.address = [0, 0]
+        self.remap = 0x40
+        self.start_line = 0
+        self.display_offset = 0x60
+        self.contrast = 0x0F
+        self.display_on = False
+        self.display_mode = 0xA6
+        self.scroll = None
+        self.scrolling = False
+        self.writing = False
+        self._command = None
+        self._parameters = []
+        self._pending_byte = None
+
+    def reset_stats(self):
+        self.transactions = []
+        self.spi_calls = 0
+        self.command_bytes = 0
+        self.data_bytes = 0
+        self.cs_toggles = 0
+        self.dc_toggles = 0
+        self.commands = {}
+        self.warnings = []
+        self._transaction = 0
+
+    def stats(self):
+        """
+        :return: traffic counters since the last reset_stats
+        """
+        total = self.command_bytes + self.data_bytes
+        return {"transactions": len(self.transactions), "spi_calls": self.spi_calls,
+                "command_bytes": self.command_bytes, "data_bytes": self.data_bytes,
+                "cs_toggles": self.cs_toggles, "dc_toggles": self.dc_toggles,
+                "bus_seconds": total * 8.0 / self.speed_hz}
+
+    def pin(self, name, value):
+        """
+        Level change on one of the control lines
+        :param name: "cs", "dc" or "rst"
+        """
+        value = 1 if value else 0
+        if self.pins[name] == value:
+            return
+        self.pins[name] = value
+        if name == "cs":
+            self.cs_toggles += 1
+            if value == 0:
+                self._transaction = 0
+            else:
+                self.transactions.append(self._transaction)
+        elif name == "dc":
+            self.dc_toggles += 1
+        elif value == 0:
+            self.reset()
+
+    def write(self, data):
+        """
+        Bytes clocked in on MOSI during one spidev call
+        :param data: bytes-like object
+        """
+        self.spi_calls += 1
+        data = np.frombuffer(bytes(data), dtype=np.uint8)
+        if self.realtime:
+            time.sleep(len(data) * 8.0 / self.speed_hz)
+        if self.pins["cs"]:
+            self.warnings.append("%d bytes sent with CS high" % len(data))
+            return
+        self._transaction += len(data)
+        if self.pins["dc"]:
+            self.data_bytes += len(data)
+            self._data(data)
+        else:
+            self.command_bytes += len(data)
+            for byte in data:
+                self._start_command(int(byte))
+
+    def _start_command(self, command):
+        if self._command is not None:
+            self.warnings.append("command 0x%02X sent before the parameters of 0x%02X" % (command, self._command))
+        self.commands[command] = self.commands.get(command, 0) + 1
+        self.writing = False
+        self._pending_byte = None
+        self._parameters = []
+        if PARAMETERS.get(command, 0):
+            self._command = command
+        else:
+            self._command = None
+            self._execute(command, [])
+
+    def _data(self, data):
+        if self._command is not None:
+            needed = PARAMETERS[self._command] - len(self._parameters)
+            self._parameters.extend(int(byte) for byte in data[:needed])
+            data = data[needed:]
+            if len(self._parameters) == PARAMETERS[self._command]:
+                command, self._command = self._command, None
+                self._execute(command, self._parameters)
+        if not len(data):
+            return
+        if not self.writing:
+            self.warnings.append("%d data bytes outside of a command" % len(data))
+            return
+        if self._pending_byte is not None:
+            data = np.concatenate(([self._pending_byte], data))
+            self._pending_byte = None
+        if len(data) % 2:
+            self._pending_byte = data[-1]
+            data = data[:-1]
+        words = (data[0::2].astype(np.uint16) << 8) | data[1::2]
+        self._write_ram(words)
+
+    def _write_ram(self, words):
+        # Walk the column/row window from the current address, wrapping like the controller
+        x0, x1 = self.column
+        y0, y1 = self.row
+        width = x1 - x0 + 1
+        height = y1 - y0 + 1
+        if self.remap & 0x01:
+            start = (self.address[0] - x0) * height + (self.address[1] - y0)
+            steps = start + np.arange(len(words))
+            cols = x0 + (steps // height) % width
+            rows = y0 + steps % height
+        else:
+            start = (self.address[1] - y0) * width + (self.address[0] - x0)
+            steps = start + np.arange(len(words))
+            cols = x0 + steps % width
+            rows = y0 + (steps // width) % height
+        self.ram[rows, cols] = words
+        following = start + len(words)
+        if self.remap & 0x01:
+            self.address = [x0 + (following // height) % width, y0 + following % height]
+        else:
+            self.address = [x0 + following % width, y0 + (following // width) % height]
+
+    def _execute(self, command, parameters):
+        if command == 0x15:
+            self.column = [min(parameters[0], WIDTH - 1), min(parameters[1], WIDTH - 1)]
+            self.address[0] = self.column[0]
+        elif command == 0x75:
+            self.row = [min(parameters[0], HEIGHT - 1), min(parameters[1], HEIGHT - 1)]
+            self.address[1] = self.row[0]
+        elif command == 0x5C:
+            self.writing = True
+        elif command == 0xA0:
+            self.remap = parameters[0]
+        elif command == 0xA1:
+            self.start_line = parameters[0] & 0x7F
+        elif command == 0xA2:
+            self.display_offset = parameters[0] & 0x7F
+        elif command in (0xA4, 0xA5, 0xA6, 0xA7):
+            self.display_mode = command
+        elif command == 0xAE:
+            self.display_on = False
+        elif command == 0xAF:
+            self.display_on = True
+        elif command == 0xC7:
+            self.contrast = parameters[0] & 0x0F
+        elif command == 0x96:
+            self.scroll = list(parameters)
+        elif command == 0x9F:
+            self.scrolling = True
+        elif command == 0x9E:
+            self.scrolling = False
+
+    def frame(self):
+        """
+        :return: display RAM as a (height, width) '>u2' array, in the layout the driver sends frames
+        """
+        return self.ram.astype(">u2")
+
+    def visible(self):
+        """
+        Approximates what the panel shows: start line, display offset, contrast and display mode applied
+        :return: (height, width, 3) uint8 RGB array
+        """
+        rows = (np.arange(HEIGHT) + self.start_line - self.display_offset) % HEIGHT
+        words = self.ram[rows]
+        rgb = np.empty((HEIGHT, WIDTH, 3), dtype=np.float32)
+        rgb[:, :, 0] = (words >> 11) * (255 / 31.0)
+        rgb[:, :, 1] = ((words >> 5) & 0x3F) * (255 / 63.0)
+        rgb[:, :, 2] = (words & 0x1F) * (255 / 31.0)
+        if not self.display_on or self.display_mode == 0xA4:
+            rgb[:] = 0
+        elif self.display_mode == 0xA5:
+            rgb[:] = 255
+        elif self.display_mode == 0xA7:
+            rgb = 255 - rgb
+        rgb *= (self.contrast + 1) / 16.0
+        return (rgb + 0.5).astype(np.uint8)
+
+
+class VirtualGPIO(object):
+    """
+    Stands in for the RPi.GPIO module: control lines go to the panel, inputs can be pressed from code
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, panel, rst_pin, dc_pin, cs_pin):
+        self.panel = panel
+        self.lines = {rst_pin: "rst", dc_pin: "dc", cs_pin: "cs"}
+        self.levels = {}
+        self.callbacks = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        self.levels.setdefault(pin, 0)
+
+    def output(self, pin, value):
+        self.levels[pin] = value
+        if pin in self.lines:
+            self.panel.pin(self.lines[pin], value)
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def press(self, pin):
+        """
+        Raises an input pin and fires its edge callback, like a button press
+        """
+        self.levels[pin] = 1
+        if self.callbacks.get(pin):
+            self.callbacks[pin](pin)
+
+    def release(self, pin):
+        self.levels[pin] = 0
+
+    def cleanup(self):
+        pass
+
+
+class VirtualSpiDev(object):
+    """
+    Stands in for spidev.SpiDev, with the same 4096 byte limit on writebytes
+    """
+    bufsiz = 4096
+
+    def __init__(self, panel):
+        self.panel = panel
+        self.max_speed_hz = panel.speed_hz
+        self.mode = 0
+
+    def writebytes(self, data):
+        if len(data) > self.bufsiz:
+            raise OverflowError("Argument list size exceeds %d bytes." % self.bufsiz)
+        self.panel.speed_hz = self.max_speed_hz
+        self.panel.write(bytearray(data))
+
+    def writebytes2(self, data):
+        self.panel.speed_hz = self.max_speed_hz
+        self.panel.write(memoryview(data).cast("B"))
+
+    def close(self):
+        pass